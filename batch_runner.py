@@ -0,0 +1,171 @@
+# EECS 442 @ UMich Final Project 
+# No commercial Use Allowed 
+
+import os
+import re
+import sys
+import json
+import time
+import glob
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+def build_batch_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-data_dir", help="directory of {idx}_naive / _target / _c_mask / _c_mask_dilated image", default='data')
+    parser.add_argument("-output_dir", help="directory to save result, log & manifest", default='output')
+    parser.add_argument("-idx", help="comma separated idx to run, default every job found in data_dir", default=None)
+    parser.add_argument("-workers", help="number of job run at the same time, 0 means size to cpu & memory", type=int, default=0)
+    parser.add_argument("-job_threads", help="torch thread of every job", type=int, default=4)
+    parser.add_argument("-job_memory", help="memory (MB) a job is expected to take, used to size workers", type=int, default=4096)
+    parser.add_argument("-timeout", help="second a stage of a job may take before it is killed, 0 means no timeout", type=float, default=0)
+    parser.add_argument("-manifest", help="./path/file of json manifest, default output_dir/manifest.json", default=None)
+    parser.add_argument("-force", help="rerun job even if output is newer than input", action='store_true')
+    parser.add_argument("-gpu", help="zero-indexed ID of the GPU to use; for CPU mode set -gpu = cpu", default='cpu')
+    return parser
+
+
+def discover_jobs(data_dir, idx=None):
+    '''
+    Return :
+        list of job sorted by idx, job is a dict of `idx`, `name` (e.g. `1` or `1_our`) & path of `content_image`,
+        `style_image`, `tight_mask`, `dilated_mask`. Job with a missing image is skipped
+    '''
+    jobs = []
+    for filename in sorted(os.listdir(data_dir)):
+        match = re.match(r'^(\d+)(.*)_naive\.\w+$', filename)
+        if match is None or (idx is not None and int(match.group(1)) not in idx):
+            continue
+        name = match.group(1) + match.group(2)
+        job = {'idx': int(match.group(1)), 'name': name, 'content_image': os.path.join(data_dir, filename)}
+        for key, suffix in [('style_image', '_target'), ('tight_mask', '_c_mask'), ('dilated_mask', '_c_mask_dilated')]:
+            found = glob.glob(os.path.join(data_dir, glob.escape(name + suffix) + '.*'))
+            if len(found) == 0:
+                print('Skip job {}, no {} image'.format(name, suffix))
+                break
+            job[key] = found[0]
+        else:
+            jobs.append(job)
+    return sorted(jobs, key=lambda job: job['idx'])
+
+
+def auto_workers(cfg):
+    '''
+    Return :
+        number of job that fit both cpu (`job_threads` each) & available memory (`job_memory` each)
+    '''
+    n_cpu = os.cpu_count() or 1
+    try:
+        memory = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (ValueError, OSError, AttributeError):
+        # not available on this platform, only limit by cpu 
+        memory = float('inf')
+    return int(max(1, min(n_cpu // max(1, cfg.job_threads), memory // max(1, cfg.job_memory))))
+
+
+def up_to_date(output, inputs):
+    if not os.path.exists(output):
+        return False
+    return all(os.path.getmtime(output) >= os.path.getmtime(path) for path in inputs if os.path.exists(path))
+
+
+def run_stage(stage, cfg, log_file):
+    '''
+    Input :
+        stage : dict of `name`, `cmd` (argument list of python script), `inputs`, `output`
+    Return :
+        dict of `status` ('done' / 'failed' / 'timeout'), `returncode`, `time` (second) & `log`
+    '''
+    env = dict(os.environ, OMP_NUM_THREADS=str(cfg.job_threads), MKL_NUM_THREADS=str(cfg.job_threads))
+    start_time = time.time()
+    with open(log_file, 'w') as f:
+        try:
+            returncode = subprocess.run([sys.executable] + stage['cmd'], stdout=f, stderr=subprocess.STDOUT, env=env,
+                                        timeout=cfg.timeout if cfg.timeout > 0 else None).returncode
+            status = 'done' if returncode == 0 and os.path.exists(stage['output']) else 'failed'
+        except subprocess.TimeoutExpired:
+            returncode, status = None, 'timeout'
+    return {'status': status, 'returncode': returncode, 'time': time.time() - start_time, 'log': log_file}
+
+
+def run_job(job, stages, cfg, previous=None):
+    '''
+    Functionality :
+        run every stage of a job in order, stage that finished in an earlier run & whose output is newer than its input
+        is skipped, a failed stage stop the rest of the job
+    Input :
+        previous : record of the job in the manifest of an earlier run, None if there is no record
+    Return :
+        record of the job for manifest
+    Notice :
+        output mtime alone is not enough, a stage that time out or is stopped may have left an output from an older run
+    '''
+    previous_stages = {} if previous is None else previous.get('stages', {})
+    record = {'name': job['name'], 'status': 'done', 'stages': {}}
+    for stage in stages:
+        finished = previous_stages.get(stage['name'], {}).get('status') in ('done', 'skipped')
+        if not cfg.force and finished and up_to_date(stage['output'], stage['inputs']):
+            record['stages'][stage['name']] = {'status': 'skipped', 'time': 0, 'output': stage['output']}
+            continue
+
+        log_file = os.path.join(cfg.output_dir, '{}_{}.log'.format(job['name'], stage['name']))
+        result = run_stage(stage, cfg, log_file)
+        result['output'] = stage['output']
+        record['stages'][stage['name']] = result
+        if result['status'] != 'done':
+            record['status'] = result['status']
+            break
+
+    if all(stage['status'] == 'skipped' for stage in record['stages'].values()):
+        record['status'] = 'skipped'
+    return record
+
+
+def run_batch(cfg, stage_fn):
+    '''
+    Functionality :
+        discover job in `cfg.data_dir` & run them in parallel, manifest is rewritten as every job finish
+    Input :
+        stage_fn : function of (job, cfg) return the list of stage of that job
+    Notice :
+        every stage run as its own process, so a crash / timeout of one job do not affect other job
+    '''
+    if not os.path.exists(cfg.output_dir):
+        os.makedirs(cfg.output_dir)
+    if cfg.manifest is None:
+        cfg.manifest = os.path.join(cfg.output_dir, 'manifest.json')
+
+    idx = None if cfg.idx is None else [int(i) for i in cfg.idx.split(',')]
+    jobs = discover_jobs(cfg.data_dir, idx)
+    workers = cfg.workers if cfg.workers > 0 else auto_workers(cfg)
+    print('\n===> Run {} job with {} worker'.format(len(jobs), workers))
+
+    # Keep record of job that is not run this time 
+    manifest = {'jobs': {}}
+    if os.path.exists(cfg.manifest):
+        with open(cfg.manifest) as f:
+            manifest = json.load(f)
+
+    def write_manifest():
+        with open(cfg.manifest + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(cfg.manifest + '.tmp', cfg.manifest)
+
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run_job, job, stage_fn(job, cfg), cfg, manifest['jobs'].get(job['name'])): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                record = future.result()
+            except Exception as e:
+                record = {'name': job['name'], 'status': 'failed', 'error': repr(e), 'stages': {}}
+            manifest['jobs'][job['name']] = record
+            write_manifest()
+            print('Job {} {} ({})'.format(job['name'], record['status'], ', '.join('{} {} {:.1f}s'.format(name, stage['status'], stage['time']) for name, stage in record['stages'].items())))
+
+    status = [manifest['jobs'][job['name']]['status'] for job in jobs]
+    print('@ Time Spend {:.04f} s, {} done, {} skipped, {} failed'.format(time.time() - start_time, status.count('done'), status.count('skipped'), len(status) - status.count('done') - status.count('skipped')))
+    return manifest
@@ -0,0 +1,50 @@
+import json
+import argparse
+import numpy as np
+import torch
+from os import path
+
+# Convert VGG weight into a flat weight file that build_backbone can memory map, only the features (conv) part is kept 
+# File layout : 8 byte magic, 8 byte little endian index length, json index, tensor data aligned to 64 byte 
+magic = b'VGGFLAT1'
+align = 64
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-model_file", help="path/file to torch model weight", default=path.join("download_model_weight", "vgg19-d01eb7cb.pth"))
+parser.add_argument("-output", help="path/file to save flat weight, default model_file with .bin (_fp16.bin if fp16)", default=None)
+parser.add_argument("-fp16", help="store weight as float16, half file size, converted back to float32 when loaded", action='store_true')
+cfg = parser.parse_args()
+
+if cfg.output is None:
+    cfg.output = path.splitext(cfg.model_file)[0] + ('_fp16' if cfg.fp16 else '') + '.bin'
+
+# Keep features only, key like `0.weight` 
+sd = torch.load(cfg.model_file, map_location='cpu')
+sd = {(k[len('features.'):] if k.startswith('features.') else k): v for k, v in sd.items()}
+sd = {k: v for k, v in sd.items() if k.split('.')[0].isdigit()}
+arrays = [(k, v.detach().contiguous().numpy().astype(np.float16 if cfg.fp16 else np.float32)) for k, v in sorted(sd.items(), key=lambda kv: (int(kv[0].split('.')[0]), kv[0]))]
+
+def aligned(offset):
+    return (offset + align - 1) // align * align
+
+# Offset depend on index length, grow the reserved index length until it fit 
+index_length = 1024
+while True:
+    offset = aligned(len(magic) + 8 + index_length)
+    tensors = {}
+    for k, a in arrays:
+        tensors[k] = {'offset': offset, 'shape': list(a.shape), 'dtype': str(a.dtype)}
+        offset = aligned(offset + a.nbytes)
+    index = json.dumps({'tensors': tensors}).encode('utf-8')
+    if len(index) <= index_length:
+        break
+    index_length *= 2
+
+print("Writing {} tensor to {}".format(len(arrays), cfg.output))
+with open(cfg.output, 'wb') as f:
+    f.write(magic)
+    f.write(index_length.to_bytes(8, 'little'))
+    f.write(index.ljust(index_length))
+    for k, a in arrays:
+        f.seek(tensors[k]['offset'])
+        f.write(a.tobytes())
@@ -1,59 +1,33 @@
 # Take reference from https://github.com/DmitryUlyanov/deep-image-prior 
 import os
-import math
+from batch_runner import build_batch_parser, run_batch
 
-numImgs = 35
-# numGpus = 16 
-numGpus = 1
 
-if os.path.exists('output') == 0:
-    os.mkdir('output')
+def pass2_stages(job, cfg):
+    inter_image = os.path.join('official_result', job['name'] + '_inter_res.jpg')
+    output_img = os.path.join(cfg.output_dir, job['name'] + '_final_res.jpg')
+    print_interval = '10' if job['idx'] in [0, 2, 4, 9, 14, 26, 18, 24] else '100'
+    cmd = ['pass2.py',
+           '-content_image', job['content_image'],
+           '-style_image', job['style_image'],
+           '-tight_mask', job['tight_mask'],
+           '-dilated_mask', job['dilated_mask'],
+           '-inter_image', inter_image,
+           '-gpu', cfg.gpu,
+           '-output_img', output_img,
+           '-output_img_size', '710',
+           '-n_iter', '3000',
+           '-lr', '3e-1',
+           '-style_layers', 'relu1_1,relu2_1,relu3_1,relu4_1',
+           '-content_layers', 'relu4_1',
+           '-histogram_layers', 'relu1_1,relu4_1',
+           '-histogram_weight', '1',
+           '-verbose',
+           '-print_interval', print_interval, '-save_img_interval', print_interval]
+    inputs = [job['content_image'], job['style_image'], job['tight_mask'], job['dilated_mask'], inter_image]
+    return [{'name': 'pass2', 'cmd': cmd, 'inputs': inputs, 'output': output_img}]
 
-N = int(math.ceil(float(numImgs)/numGpus))
 
-for j in range(1, numGpus+1):
-    cmd = ''
-    for i in range(1, N+1):
-        idx = (i-1) * numGpus + (j-1)
-        if idx >= 0 and idx < numImgs:
-            print('Working on image idx = ', idx)
-            if idx in [0, 2, 4, 9, 14, 26, 18, 24]:
-                part_cmd2 =' python3 pass2.py '\
-                       ' -content_image data/' + str(idx) + '_naive.jpg  '\
-                       ' -style_image   data/' + str(idx) + '_target.jpg '\
-                       ' -tight_mask    data/' + str(idx) + '_c_mask.jpg '\
-                       ' -dilated_mask  data/' + str(idx) + '_c_mask_dilated.jpg '\
-                       ' -inter_image   official_result/' + str(idx) + '_inter_res.jpg ' \
-                       ' -gpu cpu ' \
-                       ' -output_img    output/' + str(idx) + '_final_res.jpg '\
-                       ' -output_img_size 710 ' \
-                       ' -n_iter 3000 ' \
-                       ' -lr 3e-1 ' \
-                       ' -style_layers relu1_1,relu2_1,relu3_1,relu4_1 '\
-                       ' -content_layers relu4_1 ' \
-                       ' -histogram_layers relu1_1,relu4_1 ' \
-                       ' -histogram_weight 1 ' \
-                       ' -verbose ' \
-                       ' -print_interval 10 -save_img_interval 10 &&'
-            else:
-                part_cmd2 =' python3 pass2.py '\
-                       ' -content_image data/' + str(idx) + '_naive.jpg  '\
-                       ' -style_image   data/' + str(idx) + '_target.jpg '\
-                       ' -tight_mask    data/' + str(idx) + '_c_mask.jpg '\
-                       ' -dilated_mask  data/' + str(idx) + '_c_mask_dilated.jpg '\
-                       ' -inter_image   official_result/' + str(idx) + '_inter_res.jpg ' \
-                       ' -gpu cpu ' \
-                       ' -output_img    output/' + str(idx) + '_final_res.jpg '\
-                       ' -output_img_size 710 ' \
-                       ' -n_iter 3000 ' \
-                       ' -lr 3e-1 ' \
-                       ' -style_layers relu1_1,relu2_1,relu3_1,relu4_1 '\
-                       ' -content_layers relu4_1 ' \
-                       ' -histogram_layers relu1_1,relu4_1 ' \
-                       ' -histogram_weight 1 ' \
-                       ' -verbose ' \
-                       ' -print_interval 100 -save_img_interval 100 &&'
-            cmd = cmd + part_cmd2
-    cmd = cmd[1:len(cmd)-1]
-    print('#',cmd)
-    os.system(cmd)
+if __name__ == '__main__':
+    parser = build_batch_parser()
+    run_batch(parser.parse_args(), pass2_stages)
@@ -0,0 +1,165 @@
+# EECS 442 @ UMich Final Project 
+# No commercial Use Allowed 
+
+import os
+import time
+from model import *
+from utils import *
+from pass1 import train, build_net, build_roi, train_pyramid, train_tiled, capture_fm_pass1
+from pass2 import capture_fm_pass2
+
+if not os.path.exists('output'):
+    os.makedirs('output')
+
+# Option that can be set differently for pass2, `-p2_xxx` override `-xxx` in pass2. Default follow gen_one.py 
+pass2_options = [
+    ('style_layers', str, 'relu1_1,relu2_1,relu3_1,relu4_1'),
+    ('content_layers', str, 'relu4_1'),
+    ('histogram_layers', str, None),
+    ('content_weight', float, None),
+    ('style_weight', float, None),
+    ('tv_weight', float, None),
+    ('histogram_weight', float, None),
+    ('lr', float, None),
+    ('n_iter', int, None),
+]
+
+
+def get_harmonize_args(argv=None):
+    '''
+    Return :
+        cfg1, cfg2 : config of pass1 & pass2, same as get_args() of pass1.py / pass2.py
+    Notice :
+        1. cfg1.output_img is the intermediate result (`-inter_output`), cfg2.output_img is the final result
+        2. `-inter_image` is not used, intermediate image is passed as tensor
+    '''
+    parser = build_parser()
+    parser.set_defaults(output_img='output/0_final_res.png')
+    parser.add_argument('-inter_output', help='./path/file to save pass1 result, default output_img with _inter', default=None)
+    for name, arg_type, default in pass2_options:
+        parser.add_argument('-p2_' + name, help='{} for pass2, default same as pass1'.format(name) if default is None else '{} for pass2'.format(name), type=arg_type, default=default)
+
+    cfg1 = get_args(argv, parser)
+    cfg1.inter_image = None
+    assert(cfg1.batch_file is None), '-batch_file is not supported by harmonize.py / worker.py, run pass1.py & pass2.py with -batch_file'
+    if cfg1.inter_output is None:
+        output_filename, file_extension = os.path.splitext(cfg1.output_img)
+        cfg1.inter_output = str(output_filename) + '_inter' + str(file_extension)
+
+    cfg2 = copy.copy(cfg1)
+    for name, _, _ in pass2_options:
+        if getattr(cfg1, 'p2_' + name) is not None:
+            setattr(cfg2, name, getattr(cfg1, 'p2_' + name))
+
+    cfg1.output_img = cfg1.inter_output
+    cfg1.histogram_weight = 0 # histogram loss is only used in pass2 (`-histogram_weight` go to pass2)
+
+    print('pass2 style loss layer', cfg2.style_layers)
+    print('pass2 content loss layer', cfg2.content_layers)
+
+    return cfg1, cfg2
+
+
+def run_pass(cfg, device, dtype, backbone, optim_img, images, tight_mask, loss_mask, StyleLoss, capture_fn, style_img=None, canvas_size=None):
+    '''
+    Functionality :
+        build net, capture & train for one pass, same as main() of pass1.py / pass2.py
+    Input :
+        style_img : tiled mode only, see train_tiled (pass1 match style over the style window, pass2 crop style to the tile)
+        canvas_size : (H, W) of the whole image in roi mode, see build_net
+    '''
+    if cfg.tile_size > 0:
+        return train_tiled(cfg, device, dtype, optim_img, images, tight_mask, loss_mask, StyleLoss, capture_fn, backbone=backbone, style_img=style_img)
+    elif cfg.pyramid_levels > 1:
+        return train_pyramid(cfg, device, dtype, optim_img, images, tight_mask, loss_mask, StyleLoss, capture_fn, backbone=backbone)
+
+    content_loss_list, style_loss_list, tv_loss_list, histogram_loss_list, net = build_net(cfg, device, dtype, tight_mask, loss_mask, StyleLoss, ContentLoss, TVLoss, HistogramLoss, backbone=backbone, canvas_size=canvas_size)
+    resume_state = load_checkpoint(cfg, device) if cfg.resume else None
+    if resume_state is None:
+        capture_fn(content_loss_list, style_loss_list, tv_loss_list, histogram_loss_list, images, net)
+    result = train(cfg, device, dtype, net, tight_mask, loss_mask, optim_img, content_loss_list, style_loss_list, tv_loss_list, histogram_loss_list, resume_state=resume_state)
+    del net
+    return result
+
+
+def harmonize(cfg1, cfg2, dtype, device, backbone, plot=True):
+    '''
+    Functionality :
+        run pass1 & pass2 on one image with an already built backbone
+    Input :
+        cfg1, cfg2 : from get_harmonize_args
+        plot : save loss plot of both pass (pyplot is not thread safe, worker turn it off)
+    Return :
+        dict of output path (`inter_img`, `output_img`, `cropped_img`) & time spend of every stage in second (`timing`)
+    '''
+    timing = {}
+    start_time = time.time()
+    content_img, style_img, _, tight_mask, loss_mask = preprocess(cfg1, dtype, device)
+    timing['preprocess'] = time.time() - start_time
+
+    # Crop everything to the region of interest 
+    if cfg1.roi:
+        # Margin & alignment of the deepest layer of both pass 
+        roi_cfg = copy.copy(cfg2)
+        roi_cfg.content_layers = cfg1.content_layers + ',' + cfg2.content_layers
+        roi_cfg.style_layers = cfg1.style_layers + ',' + cfg2.style_layers
+        bbox = build_roi(roi_cfg, loss_mask)
+        full_content_img, full_style_img, full_tight_mask = content_img, style_img, tight_mask
+        content_img, style_img, tight_mask, loss_mask = [roi_crop(x, bbox) for x in (content_img, style_img, tight_mask, loss_mask)]
+
+    # Pass1 
+    print('\n===> Pass1')
+    pass_start = time.time()
+    capture_fn = lambda c_list, s_list, tv_list, h_list, images, net, style_fms=None: capture_fm_pass1(c_list, s_list, tv_list, *images, net, style_fms=style_fms)
+    inter_img, content_loss_his, style_loss_his, tv_loss_his, histogram_loss_his = run_pass(cfg1, device, dtype, backbone, content_img, [content_img, style_img], tight_mask, loss_mask, StyleLossPass1, capture_fn, style_img=style_img)
+    inter_img = inter_img.detach()
+    if plot:
+        plt_plot_loss(content_loss_his, style_loss_his, tv_loss_his, histogram_loss_his, name='pass1')
+    timing['pass1'] = time.time() - pass_start
+
+    # Pass2, start from pass1 result kept in memory 
+    print('\n===> Pass2')
+    pass_start = time.time()
+    capture_fn = lambda c_list, s_list, tv_list, h_list, images, net: capture_fm_pass2(c_list, s_list, tv_list, h_list, *images, net)
+    canvas_size = tuple(full_content_img.shape[2:]) if cfg1.roi else None
+    final_img, content_loss_his, style_loss_his, tv_loss_his, histogram_loss_his = run_pass(cfg2, device, dtype, backbone, inter_img, [inter_img, content_img, style_img], tight_mask, loss_mask, StyleLossPass2, capture_fn, canvas_size=canvas_size)
+    if plot:
+        plt_plot_loss(content_loss_his, style_loss_his, tv_loss_his, histogram_loss_his, name='pass2')
+    timing['pass2'] = time.time() - pass_start
+
+    # Put the optimized roi back to the whole canvas & overwrite the (roi sized) output image 
+    if cfg1.roi:
+        inter_img = roi_paste(full_content_img, inter_img, bbox)
+        final_img = roi_paste(full_content_img, final_img, bbox)
+        style_img, tight_mask = full_style_img, full_tight_mask
+        img_deprocess(inter_img.clone()).save(str(cfg1.output_img))
+        img_deprocess(final_img.clone()).save(str(cfg2.output_img))
+
+    # Crop output & save 
+    tight_mask_crop(cfg1, inter_img, style_img, tight_mask)
+    final_img = tight_mask_crop(cfg2, final_img, style_img, tight_mask)
+    timing['total'] = time.time() - start_time
+
+    output_filename, file_extension = os.path.splitext(cfg2.output_img)
+    return {'inter_img': cfg1.output_img, 'output_img': cfg2.output_img, 'cropped_img': str(output_filename) + '_cropped_' + str(file_extension), 'timing': timing}
+
+
+def main():
+    # Initial Config 
+    cfg1, cfg2 = get_harmonize_args()
+
+    # Setup Log 
+    orig_stdout = init_log(cfg1)
+
+    # Initial Config, backbone is shared by both pass 
+    dtype, device = setup(cfg1)
+    backbone = build_backbone(cfg1, layers=loss_layer_names(cfg1) + loss_layer_names(cfg2))
+
+    harmonize(cfg1, cfg2, dtype, device, backbone)
+
+    # End Log 
+    end_log(orig_stdout)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,9 +6,9 @@ import torch
 import torch.nn as nn
 import torch.optim as optim
 import torchvision.transforms as transforms
-import torchvision.models as models
 import torchvision
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from PIL import Image
 import argparse
 import copy
@@ -17,6 +17,7 @@ import numpy as np
 import scipy.interpolate as interpolate
 import matplotlib.pyplot as plt
 import time
+import json
 
 vgg16_dict = [
     'conv1_1', 'relu1_1', 'conv1_2', 'relu1_2', 'pool1',
@@ -50,8 +51,461 @@ def get_patch(padding_feature, pos_h, pos_w, patch_size=3):
     return padding_feature[:, :, pos_h: pos_h + patch_size, pos_w: pos_w + patch_size].clone()
 
 
-def build_backbone(cfg):
+def extract_patches(padding_feature, patch_size=3, stride=1):
     '''
+    unfold every patch of a padded feature map into a patch bank
+
+    :param padding_feature: 1 * C * (H + pad) * (W + pad)
+    :param patch_size:
+    :param stride:
+    :return: patches: L * (C * patch_size * patch_size), patches are in row-major order of their location
+    '''
+    return F.unfold(padding_feature, kernel_size=patch_size, stride=stride)[0].t()
+
+
+def gather_patches(padding_feature, pos_h, pos_w, patch_size=3):
+    '''
+    vectorized version of `get_patch`, return patches from feature at every (pos_h[k], pos_w[k])
+
+    :param padding_feature: 1 * C * (H + pad) * (W + pad)
+    :param pos_h: N LongTensor
+    :param pos_w: N LongTensor
+    :param patch_size:
+    :return: patches: N * (C * patch_size * patch_size), same layout as `extract_patches`
+    '''
+    offset = torch.arange(patch_size, device=padding_feature.device)
+    rows = (pos_h.view(-1, 1) + offset.view(1, -1)).view(-1, patch_size, 1)
+    cols = (pos_w.view(-1, 1) + offset.view(1, -1)).view(-1, 1, patch_size)
+    patches = padding_feature[0][:, rows, cols]  # C * N * patch_size * patch_size
+    return patches.transpose(0, 1).reshape(pos_h.shape[0], -1)
+
+
+def match_patch_bank(content_fm_pad, style_fm_pad, n_patch_h, n_patch_w, patch_size=3, stride=1, mem_budget=256, positions=None):
+    '''
+    Exhaustive patch match between content fm & style fm, done as chunked matrix multiplication
+
+    :param content_fm_pad: 1 * C * (H + pad) * (W + pad), padded content feature map
+    :param style_fm_pad: 1 * C * (H + pad) * (W + pad), padded style feature map
+    :param n_patch_h: number of content patch along height
+    :param n_patch_w: number of content patch along width
+    :param patch_size:
+    :param stride: stride over style feature map
+    :param mem_budget: memory (MB) a single block of score is allowed to take
+    :param positions: N LongTensor, row-major index of content patch to match. If None, match every content patch
+    :return: match_idx: N (or n_patch_h * n_patch_w) LongTensor, row-major index into the style patch grid
+             n_style_w: number of style patch along width, used to decode match_idx into (y, x)
+    Process:
+        content patches & style patches are unfolded into two patch banks (one row per patch)
+        score(i, j) = <content_i, style_j> / (|content_i| * |style_j| + 1e-9), same normalization as the score map
+        the full (n_content * n_style) score matrix is never built, it's computed block by block and only
+            the running maximal score & index of each content patch is kept (first maximal index wins, like argmax)
+    '''
+    if positions is None:
+        content_bank = extract_patches(content_fm_pad, patch_size, 1)  # (H * W) * (C * patch_size * patch_size)
+        content_h = content_fm_pad.shape[2] - patch_size + 1
+        content_w = content_fm_pad.shape[3] - patch_size + 1
+        content_bank = content_bank.view(content_h, content_w, -1)[:n_patch_h, :n_patch_w].reshape(n_patch_h * n_patch_w, -1)
+    else:
+        # Only unfold the patch we need, so cost scale with number of positions
+        content_bank = gather_patches(content_fm_pad, positions // n_patch_w, positions % n_patch_w, patch_size)
+    style_bank = extract_patches(style_fm_pad, patch_size, stride)  # n_style * (C * patch_size * patch_size)
+    n_style_w = (style_fm_pad.shape[3] - patch_size) // stride + 1
+
+    content_norm = content_bank.pow(2).sum(1) ** 0.5
+    style_norm = style_bank.pow(2).sum(1) ** 0.5
+
+    # Pick block size so that a single score block fit into the memory budget
+    n_content, n_style = content_bank.shape[0], style_bank.shape[0]
+    budget = max(1, int(mem_budget * 2 ** 20) // content_bank.element_size())
+    style_chunk = min(n_style, max(1, budget // min(n_content, 64)))
+    content_chunk = min(n_content, max(1, budget // style_chunk))
+
+    best_score = torch.full((n_content,), -float('inf'), dtype=content_bank.dtype, device=content_bank.device)
+    best_idx = torch.zeros((n_content,), dtype=torch.long, device=content_bank.device)
+
+    for c_start in range(0, n_content, content_chunk):
+        c_end = min(c_start + content_chunk, n_content)
+        for s_start in range(0, n_style, style_chunk):
+            s_end = min(s_start + style_chunk, n_style)
+
+            score = torch.mm(content_bank[c_start:c_end], style_bank[s_start:s_end].t())
+            score.div_(content_norm[c_start:c_end].unsqueeze(1) * style_norm[s_start:s_end].unsqueeze(0) + 1e-9)
+            block_score, block_idx = score.max(1)
+
+            # Only replace when strictly better, keep the earlier index on tie
+            update = block_score > best_score[c_start:c_end]
+            best_score[c_start:c_end][update] = block_score[update]
+            best_idx[c_start:c_end][update] = block_idx[update] + s_start
+
+    return best_idx, n_style_w
+
+
+def score_candidates(content_bank, content_norm, style_bank, style_norm, cand, chunk):
+    '''
+    normalized score between every content patch & one candidate style patch of its own
+
+    :param content_bank: N * D, content patches
+    :param content_norm: N, norm of content patches
+    :param style_bank: n_style * D, style patches (contiguous, for fast row gather)
+    :param style_norm: n_style, norm of style patches
+    :param cand: N LongTensor, row-major index of the candidate style patch of each content patch
+    :param chunk: number of content patch scored at once
+    :return: score: N
+    '''
+    n_content = content_bank.shape[0]
+    score = torch.empty((n_content,), dtype=content_bank.dtype, device=content_bank.device)
+    for start in range(0, n_content, chunk):
+        end = min(start + chunk, n_content)
+        dot = torch.bmm(content_bank[start:end].unsqueeze(1), style_bank[cand[start:end]].unsqueeze(2)).view(-1)
+        score[start:end] = dot / (content_norm[start:end] * style_norm[cand[start:end]] + 1e-9)
+    return score
+
+
+def match_patchmatch(content_fm_pad, style_fm_pad, n_patch_h, n_patch_w, patch_size=3, n_iter=5, mem_budget=256, positions=None, seed=0):
+    '''
+    Approximate patch match between content fm & style fm with PatchMatch (Barnes et al. 2009), stride is fixed to 1
+
+    :param content_fm_pad: 1 * C * (H + pad) * (W + pad), padded content feature map
+    :param style_fm_pad: 1 * C * (H + pad) * (W + pad), padded style feature map
+    :param n_patch_h: number of content patch along height
+    :param n_patch_w: number of content patch along width
+    :param patch_size:
+    :param n_iter: number of propagation + random search iteration
+    :param mem_budget: memory (MB) the gathered candidate patches are allowed to take at once
+    :param positions: N LongTensor, row-major index of content patch to match. If None, match every content patch
+    :param seed: seed of the random candidate, own generator is used so the match does not depend on earlier match in the process
+    :return: match_idx: N (or n_patch_h * n_patch_w) LongTensor, row-major index into the style patch grid
+             n_style_w: number of style patch along width, used to decode match_idx into (y, x)
+    Process:
+        score is the same normalized score as `match_patch_bank`, but only a handful of candidate is scored per location
+        1. initialize the nearest neighbor field (NNF) with the better of the same location & a random location
+        2. each iteration, propagate the match of the 4 neighbor (shift by the offset) and do random search around
+           the current match with radius halving from the style fm size down to 1
+        all location are updated at once in each step, so there's no python loop over location
+    '''
+    device = content_fm_pad.device
+    if positions is None:
+        positions = torch.arange(n_patch_h * n_patch_w, device=device)
+    pos_h, pos_w = positions // n_patch_w, positions % n_patch_w
+    generator = torch.Generator(device=device)
+    generator.manual_seed(seed)
+
+    content_bank = gather_patches(content_fm_pad, pos_h, pos_w, patch_size)  # N * (C * patch_size * patch_size)
+    style_bank = extract_patches(style_fm_pad, patch_size, 1).contiguous()  # n_style * (C * patch_size * patch_size), contiguous for fast row gather
+    n_style_h = style_fm_pad.shape[2] - patch_size + 1
+    n_style_w = style_fm_pad.shape[3] - patch_size + 1
+
+    content_norm = content_bank.pow(2).sum(1) ** 0.5
+    style_norm = style_bank.pow(2).sum(1) ** 0.5
+
+    n_content = content_bank.shape[0]
+    chunk = max(1, int(mem_budget * 2 ** 20) // (content_bank.element_size() * content_bank.shape[1]))
+
+    def compute_score(cand_h, cand_w):
+        return score_candidates(content_bank, content_norm, style_bank, style_norm, cand_h * n_style_w + cand_w, chunk)
+
+    def improve(cand_h, cand_w):
+        cand_h = cand_h.clamp(0, n_style_h - 1)
+        cand_w = cand_w.clamp(0, n_style_w - 1)
+        score = compute_score(cand_h, cand_w)
+        update = score > best_score
+        best_score[update] = score[update]
+        best_h[update] = cand_h[update]
+        best_w[update] = cand_w[update]
+
+    # NNF over the whole content grid, so that location can look up the match of its neighbor
+    nnf_h = torch.zeros((n_patch_h, n_patch_w), dtype=torch.long, device=device)
+    nnf_w = torch.zeros((n_patch_h, n_patch_w), dtype=torch.long, device=device)
+
+    # Step 1 : initialize with same location, then random location
+    best_h, best_w = pos_h.clamp(0, n_style_h - 1), pos_w.clamp(0, n_style_w - 1)
+    best_score = compute_score(best_h, best_w)
+    improve(torch.randint(0, n_style_h, (n_content,), device=device, generator=generator), torch.randint(0, n_style_w, (n_content,), device=device, generator=generator))
+
+    # Step 2 : propagation & random search
+    for _ in range(n_iter):
+        nnf_h[pos_h, pos_w] = best_h
+        nnf_w[pos_h, pos_w] = best_w
+
+        for dh, dw in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
+            neighbor_h = (pos_h + dh).clamp(0, n_patch_h - 1)
+            neighbor_w = (pos_w + dw).clamp(0, n_patch_w - 1)
+            improve(nnf_h[neighbor_h, neighbor_w] - dh, nnf_w[neighbor_h, neighbor_w] - dw)
+
+        radius = max(n_style_h, n_style_w)
+        while radius >= 1:
+            improve(best_h + torch.randint(-radius, radius + 1, (n_content,), device=device, generator=generator),
+                    best_w + torch.randint(-radius, radius + 1, (n_content,), device=device, generator=generator))
+            radius = radius // 2
+
+    return best_h * n_style_w + best_w, n_style_w
+
+
+def upsample_match_idx(coarse_idx, h, w, n_style_h, n_style_w):
+    '''
+    Turn the match of a deeper (coarser) layer into a guess of match for a shallower (finer) layer
+
+    :param coarse_idx: 2 * h_coarse * w_coarse, correspond_idx from `match_fm` of the coarser layer (first channel is y)
+    :param h: height of the finer layer
+    :param w: width of the finer layer
+    :param n_style_h: number of style patch along height in the finer layer
+    :param n_style_w: number of style patch along width in the finer layer
+    :return: init_h, init_w : h * w LongTensor, guessed match (y, x) for every finer location
+    Process:
+        finer location (y, x) fall into coarser location (yc, xc), its guess is the scaled match of (yc, xc) plus
+            the offset of (y, x) inside the coarser cell
+    '''
+    coarse_idx = coarse_idx.long()
+    coarse_h, coarse_w = coarse_idx.shape[1], coarse_idx.shape[2]
+    ys, xs = torch.arange(h), torch.arange(w)
+    yc = (ys * coarse_h // h).clamp(max=coarse_h - 1)
+    xc = (xs * coarse_w // w).clamp(max=coarse_w - 1)
+
+    init_h = coarse_idx[0][yc][:, xc] * h // coarse_h + (ys - yc * h // coarse_h).view(-1, 1)
+    init_w = coarse_idx[1][yc][:, xc] * w // coarse_w + (xs - xc * w // coarse_w).view(1, -1)
+
+    return init_h.clamp(0, n_style_h - 1), init_w.clamp(0, n_style_w - 1)
+
+
+def match_local_window(content_fm_pad, style_fm_pad, n_patch_h, n_patch_w, init_h, init_w, patch_size=3, radius=2, mem_budget=256, positions=None):
+    '''
+    Refine a guessed match with exhaustive search inside a small window around the guess, stride is fixed to 1
+
+    :param content_fm_pad: 1 * C * (H + pad) * (W + pad), padded content feature map
+    :param style_fm_pad: 1 * C * (H + pad) * (W + pad), padded style feature map
+    :param n_patch_h: number of content patch along height
+    :param n_patch_w: number of content patch along width
+    :param init_h: n_patch_h * n_patch_w LongTensor, guessed match (y) in style fm, see `upsample_match_idx`
+    :param init_w: n_patch_h * n_patch_w LongTensor, guessed match (x) in style fm
+    :param patch_size:
+    :param radius: window is (2 * radius + 1) * (2 * radius + 1) around the guess
+    :param mem_budget: memory (MB) the gathered candidate patches are allowed to take at once
+    :param positions: N LongTensor, row-major index of content patch to match. If None, match every content patch
+    :return: match_idx: N (or n_patch_h * n_patch_w) LongTensor, row-major index into the style patch grid
+             n_style_w: number of style patch along width, used to decode match_idx into (y, x)
+    '''
+    device = content_fm_pad.device
+    if positions is None:
+        positions = torch.arange(n_patch_h * n_patch_w, device=device)
+    pos_h, pos_w = positions // n_patch_w, positions % n_patch_w
+
+    content_bank = gather_patches(content_fm_pad, pos_h, pos_w, patch_size)  # N * (C * patch_size * patch_size)
+    style_bank = extract_patches(style_fm_pad, patch_size, 1).contiguous()  # n_style * (C * patch_size * patch_size)
+    n_style_h = style_fm_pad.shape[2] - patch_size + 1
+    n_style_w = style_fm_pad.shape[3] - patch_size + 1
+
+    content_norm = content_bank.pow(2).sum(1) ** 0.5
+    style_norm = style_bank.pow(2).sum(1) ** 0.5
+    chunk = max(1, int(mem_budget * 2 ** 20) // (content_bank.element_size() * content_bank.shape[1]))
+
+    guess_h, guess_w = init_h.to(device)[pos_h, pos_w], init_w.to(device)[pos_h, pos_w]
+    best_score = torch.full((content_bank.shape[0],), -float('inf'), dtype=content_bank.dtype, device=device)
+    best_h, best_w = guess_h.clone(), guess_w.clone()
+
+    for dh in range(-radius, radius + 1):
+        for dw in range(-radius, radius + 1):
+            cand_h = (guess_h + dh).clamp(0, n_style_h - 1)
+            cand_w = (guess_w + dw).clamp(0, n_style_w - 1)
+            score = score_candidates(content_bank, content_norm, style_bank, style_norm, cand_h * n_style_w + cand_w, chunk)
+
+            # Only replace when strictly better, keep the earlier candidate on tie
+            update = score > best_score
+            best_score[update] = score[update]
+            best_h[update] = cand_h[update]
+            best_w[update] = cand_w[update]
+
+    return best_h * n_style_w + best_w, n_style_w
+
+
+def receptive_field(layer_list, last_layer):
+    '''
+    Return : 
+        receptive field (in pixel) & total stride of VGG from input up to `last_layer` 
+    Notice : 
+        conv in VGG are all 3 * 3 stride 1, pool are all 2 * 2 stride 2 
+    '''
+    rf, jump = 1, 1
+    for name in layer_list[:layer_list.index(last_layer) + 1]:
+        if name.startswith('conv'):
+            rf += 2 * jump
+        elif name.startswith('pool'):
+            rf += jump
+            jump *= 2
+    return rf, jump
+
+
+def tiled_features(cnn, layer_list, layers, img, tile_size, margin):
+    '''
+    Functionality : 
+        feature map of `img` at `layers`, the backbone is run tile by tile so activation memory is bounded by tile size 
+    Input : 
+        cnn, layer_list : from build_backbone 
+        tile_size : size of the tile written by each run, multiple of the total stride of the deepest layer 
+        margin : context around each tile, multiple of the total stride & no less than the receptive field 
+    Return : 
+        list of 1 * C * H * W feature map, ordered as in the network 
+    Notice : 
+        with enough margin, feature map inside each tile is the same as a forward of the whole image 
+    '''
+    n_layer = max(layer_list.index(name) for name in layers) + 1
+    H, W = img.shape[2], img.shape[3]
+
+    # Total stride & output size of each layer 
+    scales, sizes = [], []
+    scale, h, w = 1, H, W
+    for name in layer_list[:n_layer]:
+        if name.startswith('pool'):
+            scale, h, w = scale * 2, h // 2, w // 2
+        scales.append(scale)
+        sizes.append((h, w))
+
+    outputs = {}
+    with torch.no_grad():
+        for y0 in range(0, H, tile_size):
+            for x0 in range(0, W, tile_size):
+                y1, x1 = min(H, y0 + tile_size), min(W, x0 + tile_size)
+                a_y0, a_x0 = max(0, y0 - margin), max(0, x0 - margin)
+                x = img[:, :, a_y0:min(H, y1 + margin), a_x0:min(W, x1 + margin)]
+
+                for k in range(n_layer):
+                    x = cnn[k](x)
+                    if layer_list[k] not in layers:
+                        continue
+                    s, (h, w) = scales[k], sizes[k]
+                    if layer_list[k] not in outputs:
+                        outputs[layer_list[k]] = x.new_zeros((1, x.shape[1], h, w))
+                    gy0, gx0 = y0 // s, x0 // s
+                    gy1, gx1 = h if y1 == H else y1 // s, w if x1 == W else x1 // s
+                    outputs[layer_list[k]][:, :, gy0:gy1, gx0:gx1] = x[:, :, gy0 - a_y0 // s:gy1 - a_y0 // s, gx0 - a_x0 // s:gx1 - a_x0 // s]
+
+    return [outputs[name] for name in sorted(outputs, key=layer_list.index)]
+
+
+# Unknown layer name already warned about, so the warning is printed once 
+warned_layers = set()
+
+
+def known_layers(layer_list, layers):
+    '''
+    Return : 
+        name in `layers` that is a layer of the model. Unknown name is ignored like in build_net, with a warning printed once 
+    '''
+    for name in layers:
+        if name not in layer_list and name not in warned_layers:
+            print('Warning : layer {} is not a layer of the model, ignored'.format(name))
+            warned_layers.add(name)
+    return [name for name in layers if name in layer_list]
+
+
+def deepest_layer(layer_list, layers):
+    '''
+    Return : 
+        the deepest known layer in `layers`, the last layer of the model if none is known 
+    '''
+    layers = known_layers(layer_list, layers)
+    return max(layers, key=layer_list.index) if layers else layer_list[-1]
+
+
+def loss_layer_names(cfg):
+    '''
+    Return : 
+        name of every layer that may hold a loss module, histogram layer only count when histogram loss is used 
+    '''
+    layers = cfg.content_layers.split(',') + cfg.style_layers.split(',')
+    if cfg.histogram_weight > 0:
+        layers += cfg.histogram_layers.split(',')
+    return layers
+
+
+def build_trunk(layer_list, n_layer):
+    '''
+    Return : 
+        nn.Sequential of the first `n_layer` layer of VGG features, index match `models.vgg19().features` 
+    '''
+    layers, in_channels = [], 3
+    for name in layer_list[:n_layer]:
+        if name.startswith('conv'):
+            out_channels = [64, 128, 256, 512, 512][int(name[4]) - 1]
+            layers.append(nn.Conv2d(in_channels, out_channels, kernel_size=3, padding=1))
+            in_channels = out_channels
+        elif name.startswith('relu'):
+            layers.append(nn.ReLU(inplace=True))
+        else:
+            layers.append(nn.MaxPool2d(kernel_size=2, stride=2))
+    return nn.Sequential(*layers)
+
+
+# First 8 byte of weight file written by download_model_weight/convert_models.py 
+flat_weight_magic = b'VGGFLAT1'
+
+
+def is_flat_weight(model_file):
+    with open(model_file, 'rb') as f:
+        return f.read(len(flat_weight_magic)) == flat_weight_magic
+
+
+def load_flat_state_dict(model_file, n_layer):
+    '''
+    Return : 
+        state dict of the first `n_layer` layer of VGG features from a flat weight file, key like `0.weight` 
+    Notice : 
+        1. file layout : 8 byte magic, 8 byte little endian index length, json index, tensor data. 
+           Index map key to offset (from start of file, aligned to 64 byte), shape & dtype 
+        2. float32 tensor is a copy on write view of the memory mapped file, process on one host share the page cache copy. 
+           float16 tensor is converted to float32 (halve disk read but not shared) 
+    '''
+    with open(model_file, 'rb') as f:
+        f.seek(len(flat_weight_magic))
+        index_length = int.from_bytes(f.read(8), 'little')
+        index = json.loads(f.read(index_length).decode('utf-8'))
+
+    data = np.memmap(model_file, dtype=np.uint8, mode='c')
+    state_dict = {}
+    for key, entry in index['tensors'].items():
+        if int(key.split('.')[0]) >= n_layer:
+            continue
+        dtype = np.dtype(entry['dtype'])
+        n_bytes = int(np.prod(entry['shape'])) * dtype.itemsize
+        tensor = torch.from_numpy(data[entry['offset']:entry['offset'] + n_bytes].view(dtype).reshape(entry['shape']))
+        state_dict[key] = tensor if tensor.dtype == torch.float32 else tensor.float()
+    return state_dict
+
+
+def load_trunk_state_dict(model_file, n_layer):
+    '''
+    Return : 
+        state dict of the first `n_layer` layer of VGG features, key like `0.weight` 
+    Notice : 
+        1. both full torchvision checkpoint (`features.0.weight`, classifier is skipped) & features only checkpoint are accepted 
+        2. checkpoint is memory mapped when supported (torch >= 2.1 & zip format), so tensor that is not used is never read from disk 
+        3. flat weight file from download_model_weight/convert_models.py is memory mapped, see load_flat_state_dict 
+    '''
+    if is_flat_weight(model_file):
+        return load_flat_state_dict(model_file, n_layer)
+
+    try:
+        user_state_dict = torch.load(model_file, map_location='cpu', mmap=True)
+    except (TypeError, RuntimeError):
+        # Older torch or legacy (non zip) checkpoint, load everything 
+        user_state_dict = torch.load(model_file, map_location='cpu')
+
+    state_dict = {}
+    for key, value in user_state_dict.items():
+        if key.startswith('features.'):
+            key = key[len('features.'):]
+        idx = key.split('.')[0]
+        if idx.isdigit() and int(idx) < n_layer:
+            state_dict[key] = value
+    return state_dict
+
+
+def build_backbone(cfg, layers=None):
+    '''
+    Input : 
+        layers : name of layer the backbone must reach, default every loss layer of cfg. Unknown name is ignored 
+    Return : 
+        cnn : VGG features up to the deepest layer in `layers`, classifier & deeper layer are never built or loaded 
+        layer_list : name of every layer in cnn 
     Notice : 
         1. User must specify a model weight 
         2. To use default model weight, run 'models/download_models.py' to download model 
@@ -60,23 +514,28 @@ def build_backbone(cfg):
     assert (cfg.model_file is not None)
 
     if cfg.model == 'vgg16':
-        net, layer_list = models.vgg16(pretrained=False), vgg16_dict
+        layer_list = vgg16_dict
     elif cfg.model == 'vgg19':
-        net, layer_list = models.vgg19(pretrained=False), vgg19_dict
+        layer_list = vgg19_dict
     else:
         print('Model Not support, use vgg16 / vgg19')
         exit(1)
 
-    # When loading model, we asssume the model weight match the model architrcture 
-    print('Build {} with weight {}'.format(cfg.model, cfg.model_file))
-    user_state_dict = torch.load(cfg.model_file)
-    net_state_dict = net.state_dict()
-    user_state_dict = {k: v for k, v in user_state_dict.items() if k in net_state_dict}
-    net_state_dict.update(user_state_dict)
-    net.load_state_dict(net_state_dict)
+    if layers is None:
+        layers = loss_layer_names(cfg)
+    n_layer = layer_list.index(deepest_layer(layer_list, layers)) + 1
+    layer_list = layer_list[:n_layer]
 
-    # Only use the Convolutional part of the model 
-    net = net.features
+    # When loading model, we asssume the model weight match the model architrcture 
+    print('Build {} up to {} with weight {}'.format(cfg.model, layer_list[-1], cfg.model_file))
+    net = build_trunk(layer_list, n_layer)
+    state_dict = load_trunk_state_dict(cfg.model_file, n_layer)
+    try:
+        # Parameter point to the loaded (memory mapped) tensor instead of a copy 
+        net.load_state_dict(state_dict, assign=True)
+    except TypeError:
+        # torch < 2.1 
+        net.load_state_dict(state_dict)
 
     net = net.eval()
 
@@ -150,7 +609,7 @@ class ContentLoss(nn.Module):
         # Step 2 : compute loss 
         elif self.mode == 'loss':
             #self.loss = self.criterian(torch.mul(input, self.loss_mask), self.content_fm_masked) * self.weight
-            self.loss = self.criterian(torch.mul(input, self.loss_mask), self.content_fm_masked) / self.loss_mask_sum * input.nelement()
+            self.loss = self.criterian(torch.mul(input, self.loss_mask), self.content_fm_masked.expand_as(input)) / self.loss_mask_sum * input.nelement()
             self.loss = self.loss * self.weight
 
             def backward_variable_gradient_mask_hook_fn(grad):
@@ -173,32 +632,164 @@ class GramMatrix(nn.Module):
     To understand how gram matrix work, checkout `understand Gram Matrix` notebook 
     '''
 
-    def __init__(self):
+    def __init__(self, symmetric=False, block_size=128):
+        '''
+        Input : 
+            symmetric : if True, only compute the upper triangle (block_size * block_size) blocks & mirror them, 
+                        save close to half of the FLOPs when C is much larger than block_size 
+            block_size : size of the block used when symmetric 
+        '''
         super().__init__()
+        self.symmetric = symmetric
+        self.block_size = block_size
 
     def forward(self, input):
         '''
         Input : 
             input: B * C * H * W, represent feature map 
         Output : 
-            output : B * (C * C), represent gram matrix 
+            output : B * (C * C), represent gram matrix, on the same device & dtype as input 
         '''
         B, C, H, W = input.shape
-        output = torch.zeros((B, C, C))
-
-        for i in range(B):
-            fm_flat = input[i].view(C, H * W)
-            output[i] = torch.mm(fm_flat, fm_flat.t())
-
-        return output
+        return self.gram_flat(input.reshape(B, C, H * W))
 
         # B, C, H, W = input.size()
         # x_flat = input.view(C, H * W)
         # return torch.mm(x_flat, x_flat.t())
 
+    def gram_flat(self, fm_flat):
+        '''
+        Input : 
+            fm_flat: B * C * N, flattened feature map 
+        Output : 
+            output : B * (C * C) 
+        '''
+        B, C, N = fm_flat.shape
+
+        # Every batch element in one bmm 
+        if not self.symmetric or C <= self.block_size:
+            return torch.bmm(fm_flat, fm_flat.transpose(1, 2))
+
+        output = fm_flat.new_empty((B, C, C))
+        for i in range(0, C, self.block_size):
+            fm_i = fm_flat[:, i:i + self.block_size]
+            for j in range(i, C, self.block_size):
+                block = torch.bmm(fm_i, fm_flat[:, j:j + self.block_size].transpose(1, 2))
+                output[:, i:i + self.block_size, j:j + self.block_size] = block
+                if j != i:
+                    output[:, j:j + self.block_size, i:i + self.block_size] = block.transpose(1, 2)
+
+        return output
+
+
+class MaskedGramMatrix(GramMatrix):
+    '''
+    Gram matrix of (feature map * mask), only computed over the pixel where mask is nonzero 
+    Since pixel outside mask is all zero after masking, they contribute nothing to gram matrix, 
+        so FLOPs scale with mask area instead of feature map area 
+    '''
+
+    def __init__(self, mask, symmetric=False, block_size=128):
+        '''
+        Input : 
+            mask : 1 * 1 * H * W (or 1 * C * H * W expanded), weighted mask of the layer 
+            symmetric, block_size : see `GramMatrix`
+        '''
+        super().__init__(symmetric, block_size)
+        mask = mask[0, 0].reshape(-1)
+        self.idx = torch.nonzero(mask).view(-1)  # index of pixel with nonzero mask weight 
+        self.mask_weight = mask[self.idx]  # mask weight of those pixel 
+
+    def forward(self, input):
+        '''
+        Input : 
+            input: B * C * H * W, represent feature map (NOT masked)
+        Output : 
+            output : B * (C * C), gram matrix of input * mask 
+        '''
+        return self.gram_flat(self.compact(input))
+
+    def compact(self, input):
+        '''
+        Input : 
+            input: B * C * H * W, represent feature map (NOT masked)
+        Output : 
+            fm_compact : B * C * N, masked feature map of the N pixel inside mask, gradient scatter back through index_select 
+        '''
+        B, C, H, W = input.shape
+        return input.reshape(B, C, H * W).index_select(2, self.idx) * self.mask_weight
+
+
+class MaskedGramMSELoss(torch.autograd.Function):
+    '''
+    Fused (masked gram matrix -> MSE with target gram) with closed-form gradient 
+    Only the compact masked feature map & (G - T) is kept for backward, instead of the whole 
+        mask multiply / gram / mse graph 
+
+    Gradient : 
+        loss = scale * mean((G - T) ** 2), G = Fm * Fm^T, Fm = (F * mask) over pixel inside mask 
+        d loss / d G = 2 * scale * (G - T) / numel(G) 
+        d loss / d F = 2 * (d loss / d G) * Fm * mask   (G, T symmetric) 
+    Usage : 
+        output, loss = MaskedGramMSELoss.apply(input, gram, target, scale, grad_mask) 
+        output (a view of input) is passed on to the next layer, so that when `grad_mask` is given the whole gradient of 
+            input (style loss + following layers) is masked in backward, like a gradient hook. Output of a custom function 
+            can not be modified inplace, build_net use an out of place ReLU after a style loss (conv layer as loss layer). 
+            If output is not used, the function only add the style loss gradient 
+    '''
+
+    @staticmethod
+    def forward(ctx, input, gram, target, scale, grad_mask):
+        '''
+        Input : 
+            input : B * C * H * W, feature map (NOT masked)
+            gram : MaskedGramMatrix of the layer 
+            target : 1 (or B) * C * C, target gram matrix 
+            scale : loss weight 
+            grad_mask : mask multiplied to the gradient of input, None for no gradient mask 
+        '''
+        fm_compact = gram.compact(input)  # B * C * N
+        diff = gram.gram_flat(fm_compact) - target
+        loss = diff.pow(2).mean() * scale
+
+        ctx.save_for_backward(fm_compact, diff, gram.idx, gram.mask_weight)
+        ctx.input_shape = input.shape
+        ctx.scale = scale
+        ctx.grad_mask = grad_mask
+
+        # Unused output get None gradient instead of a zero filled one 
+        ctx.set_materialize_grads(False)
+
+        return input.view_as(input), loss
+
+    @staticmethod
+    def backward(ctx, grad_output, grad_loss):
+        fm_compact, diff, idx, mask_weight = ctx.saved_tensors
+        B, C, H, W = ctx.input_shape
+
+        grad_gram = diff * (2 * ctx.scale / diff.numel()) * grad_loss
+        grad_compact = 2 * torch.bmm(grad_gram, fm_compact) * mask_weight  # B * C * N
+
+        if grad_output is None:
+            grad_input = fm_compact.new_zeros((B, C, H * W))
+        else:
+            grad_input = grad_output.reshape(B, C, H * W).clone()
+        grad_input.index_add_(2, idx, grad_compact)
+        grad_input = grad_input.view(B, C, H, W)
+
+        if ctx.grad_mask is not None:
+            grad_input = grad_input * ctx.grad_mask
+
+        return grad_input, None, None, None, None
+
 
 class HistogramLoss(nn.Module):
-    def __init__(self, device, dtype, weight, loss_mask, tight_mask, n_bins):
+    def __init__(self, device, dtype, weight, loss_mask, tight_mask, n_bins, n_outside=0):
+        '''
+        Input : 
+            n_outside : number of canvas pixel (per channel) outside the feature map when image is cropped to the roi. They are 
+                        masked out, so they are counted as zero & histogram, remap & loss are the same as on the whole canvas 
+        '''
         super(HistogramLoss, self).__init__()
         self.weight = weight
         self.n_bins = n_bins
@@ -213,6 +804,7 @@ class HistogramLoss(nn.Module):
         self.mode = 'None'
         self.loss_mask_sum = 0
         self.count = 0
+        self.n_outside = n_outside
 
     def compute_histogram(self):
         assert(self.style_fm_matched is not None)
@@ -222,12 +814,9 @@ class HistogramLoss(nn.Module):
         self.loss_mask_sum = torch.sum(self.tight_mask) * self.style_fm_matched.shape[1]
 
         style_fm_matched_masked = torch.mul(self.style_fm_matched, self.tight_mask)
-        
-        self.tight_mask = self.tight_mask.cpu()
 
-        # Compute Histogram per channel of feature map (channel, 256)
-        self.style_his = torch.cat([torch.histc(style_fm_matched_masked[:, c, :, :], self.n_bins).unsqueeze(0) for c in range(style_fm_matched_masked.shape[1]) ])
-        self.style_his = self.style_his.cpu()#to(self.device) # style_his is the histogram of matched style image feature map over the masked region 
+        # Compute Histogram per channel of feature map (channel, 256), stay on device 
+        self.style_his = self.histogram(style_fm_matched_masked.reshape((style_fm_matched_masked.shape[1], -1)), n_zero=self.n_outside) # style_his is the histogram of matched style image feature map over the masked region 
 
         # Delete unused to save memory 
         del style_fm_matched_masked
@@ -236,13 +825,34 @@ class HistogramLoss(nn.Module):
         import gc
         gc.collect()
 
-    def select_idx(self, his, idx):
+    def histogram(self, fm, n_zero=0):
         '''
         Input:
-            his (tensor, (channel * 256))  
+            fm (tensor, (channel * N))
+            n_zero : number of extra zero value counted in every channel (pixel outside roi)
+        Output:
+            his (tensor, (channel * n_bins)), histogram of each channel over its own [min, max], same as `torch.histc` per channel
+        Process:
+            bin index of all channel is computed at once & counted with a single scatter_add
         '''
-        C = his.shape[0]
-        return his.view(-1)[idx.view(-1)].view(C, -1)
+        C, N = fm.shape
+        channel_min, channel_max = fm.min(1, keepdim=True)[0], fm.max(1, keepdim=True)[0]
+        if n_zero > 0:
+            channel_min, channel_max = channel_min.clamp(max=0), channel_max.clamp(min=0)
+
+        # Like torch.histc, a channel with single value is binned over [value - 1, value + 1]
+        same = channel_min == channel_max
+        channel_min = torch.where(same, channel_min - 1, channel_min)
+        channel_max = torch.where(same, channel_max + 1, channel_max)
+
+        bin_idx = ((fm - channel_min) * self.n_bins / (channel_max - channel_min)).long().clamp(0, self.n_bins - 1)
+        his = torch.zeros((C, self.n_bins), dtype=fm.dtype, device=fm.device)
+        his.scatter_add_(1, bin_idx, torch.ones_like(fm))
+        if n_zero > 0:
+            zero_idx = ((0 - channel_min) * self.n_bins / (channel_max - channel_min)).long().clamp(0, self.n_bins - 1)
+            his.scatter_add_(1, zero_idx, torch.full_like(channel_min, n_zero))
+
+        return his
 
     def remap_histogram(self, optim_img_fm):
         '''
@@ -251,50 +861,61 @@ class HistogramLoss(nn.Module):
             this function is called every iteration 
         Input:
             optim_img_fm : feature map of the optimized image 
+        Output:
+            optim_img_corr_fm (tensor, (channel * (N + n_outside))) : remapped feature map, detached & on the same device as input, 
+                                  the last n_outside column is the remapped value of the zero outside roi 
+        Process:
+            the k-th smallest value of each channel is mapped to where rank k fall in the style histogram cdf, 
+            the bin is found by binary search (torch.searchsorted) so memory is O(channel * N) instead of O(channel * N * n_bins)
         '''
         # Only Use the masked region & reshape to (channel, N)
-        optim_img_fm = torch.mul(optim_img_fm.cpu(), self.tight_mask).reshape((optim_img_fm.shape[1], -1))
+        optim_img_fm = torch.mul(optim_img_fm.detach(), self.tight_mask).reshape((optim_img_fm.shape[1], -1))
+        if self.n_outside > 0:
+            optim_img_fm = torch.cat([optim_img_fm, optim_img_fm.new_zeros((optim_img_fm.shape[0], self.n_outside))], 1)
         C, N = optim_img_fm.shape
-         
+
         # Sort feature map & remember corresponding index for each channel 
         sort_fm, sort_idx = optim_img_fm.sort(1)
-        channel_min, channel_max = optim_img_fm.min(1)[0].unsqueeze(1), optim_img_fm.max(1)[0].unsqueeze(1)
+        channel_min, channel_max = sort_fm[:, :1], sort_fm[:, -1:]
 
         step = (channel_max - channel_min) / self.n_bins
-        rng  = torch.arange(1, N+1).unsqueeze(0) #.to(self.device)
-         
+        rng = torch.arange(1, N+1, dtype=optim_img_fm.dtype, device=optim_img_fm.device).unsqueeze(0).expand(C, N).contiguous()
+
         # Since style histogran not nessary have same number of N, scale it 
-        style_his = self.style_his * N / self.style_his.sum(1).unsqueeze(1) # torch.Size([channel, 256])        
-         
+        style_his = self.style_his * N / self.style_his.sum(1).unsqueeze(1) # torch.Size([channel, 256])
+
         style_his_cdf = style_his.cumsum(1) # torch.Size([channel, 256])
-        del style_his 
-        style_his_cdf_prev = torch.cat([torch.zeros(C,1), style_his_cdf[:,:-1]],1) # torch.Size([channel, 256])
-         
-        # Find Corresponding 
-        idx = (style_his_cdf.unsqueeze(1) - rng.unsqueeze(2) < 0).sum(2).long() # index need long tensor 
-        ratio = (rng - self.select_idx(style_his_cdf_prev, idx)) / (1e-8 + self.select_idx(style_his_cdf, idx))
+        style_his_cdf_prev = torch.cat([torch.zeros_like(style_his_cdf[:, :1]), style_his_cdf[:,:-1]],1) # torch.Size([channel, 256])
+
+        # Find Corresponding bin : number of bin with cdf < rank 
+        idx = torch.searchsorted(style_his_cdf, rng).clamp(max=self.n_bins - 1) # index need long tensor 
+        del rng
+        ratio = (torch.arange(1, N+1, dtype=optim_img_fm.dtype, device=optim_img_fm.device) - style_his_cdf_prev.gather(1, idx)) / (1e-8 + style_his.gather(1, idx))
         del style_his_cdf_prev
         del style_his_cdf
-        ratio = ratio.squeeze().clamp(0,1)
-         
-        # Build Correspponding FM 
+        ratio = ratio.clamp(0,1)
+
+        # Build Correspponding FM (in sorted order) & put each value back to its original location 
         optim_img_corr_fm = channel_min + (ratio + idx) * step
         del ratio
         optim_img_corr_fm[:, -1] = channel_max[:, 0]
-        _, remap = sort_idx.sort()
-        optim_img_corr_fm = self.select_idx(optim_img_corr_fm, idx)   
-         
-        return optim_img_corr_fm#.to(self.device)
+        optim_img_corr_fm = torch.empty_like(optim_img_corr_fm).scatter_(1, sort_idx, optim_img_corr_fm)
+
+        return optim_img_corr_fm
 
     def forward(self, input):
         if self.mode == 'loss':
+            N = input.shape[2] * input.shape[3]
             if self.count % 50 == 0:
-                 
-                self.corr_fm = self.remap_histogram(input) # (channel, N) on cpu
+
+                corr_fm = self.remap_histogram(input) # (channel, N + n_outside), detached target 
+                # Pixel outside roi is zero, only its (constant) loss is kept 
+                self.corr_fm, self.outside_loss = corr_fm[:, :N], corr_fm[:, N:].pow(2).sum()
             self.count = self.count + 1 
-             
-            self.loss = self.weight * F.mse_loss(self.corr_fm, torch.mul(input.cpu(), self.tight_mask).reshape((input.shape[1], -1)))
-            self.loss = self.loss.to(self.device) * self.loss_mask_sum / input.nelement() 
+
+            n_element = input.shape[1] * (N + self.n_outside)
+            self.loss = self.weight * (F.mse_loss(torch.mul(input, self.tight_mask).reshape((input.shape[1], -1)), self.corr_fm, reduction='sum') + self.outside_loss) / n_element
+            self.loss = self.loss * self.loss_mask_sum / n_element 
 
             def backward_variable_gradient_mask_hook_fn(grad):
                 '''
@@ -303,8 +924,8 @@ class HistogramLoss(nn.Module):
                     Notice : 
                         Variable hook is used in this case, Module hook is not supported for `complex moule` 
                 '''
-                return torch.mul(grad, self.tight_mask.to(self.device))
-            
+                return torch.mul(grad, self.tight_mask)
+
             input.register_hook(backward_variable_gradient_mask_hook_fn)
 
         return input
@@ -355,17 +976,27 @@ class HistogramLoss(nn.Module):
 '''
 
 class StyleLossPass1(nn.Module):
-    def __init__(self, device, dtype, weight, loss_mask, match_patch_size, stride):
+    # Number of pixel the match region is grown around the loss mask, see `match_positions`
+    match_mask_dilate = 0
+
+    def __init__(self, device, dtype, weight, loss_mask, match_patch_size, stride, match_mem_budget=256, match_region='full',
+                 matcher='exact', patchmatch_iter=5, coarse_to_fine=False, match_window=2, gram_symmetric=False):
         super(StyleLossPass1, self).__init__()
         self.weight = weight
         self.loss_mask = loss_mask.clone()
         self.loss_mask_sum = 0
         self.patch_size = match_patch_size  # patch size for matching between feature map, in the original paper 3 is used
         self.stride = stride
+        self.match_mem_budget = match_mem_budget  # memory (MB) for a single score block during match
+        self.match_region = match_region  # 'full' : match whole feature map, 'mask' : only match location inside loss mask
+        self.matcher = matcher  # 'exact' : exhaustive search, 'patchmatch' : approximate search with PatchMatch
+        self.patchmatch_iter = patchmatch_iter
+        self.coarse_to_fine = coarse_to_fine  # if True, match is deferred to `compute_target` & guided by the deeper layer
+        self.match_window = match_window  # radius of window searched around the guess from the deeper layer
         self.device = device
         self.dtype = dtype
         #self.critertain = nn.MSELoss()
-        self.gram = GramMatrix()
+        self.gram = MaskedGramMatrix(self.loss_mask, symmetric=gram_symmetric)  # gram of (fm * loss_mask), only over pixel inside mask
         self.mode = 'None'
 
     def forward(self, input):
@@ -375,6 +1006,8 @@ class StyleLossPass1(nn.Module):
                 1.1 First set `self.mode = 'capture_content'` to capture content feature map & expanded mask to corresponding size 
                 1.2 Then set `self.mode = 'capture_style'` to capture style feature map & compute match relation between 
                     style feature map and content feature map & compute style image gram matrix under masked region
+                    if `self.coarse_to_fine`, only style feature map is captured here, match & gram is computed by
+                    `compute_target` after all layers captured their style feature map (from the deepest layer to the shallowest)
             2. During update image, set `self.mode = 'loss'` to compute loss between content image gram matrix and stle image gram matrix 
                & return input
         '''
@@ -389,56 +1022,66 @@ class StyleLossPass1(nn.Module):
 
         # Step 2 : Capture Style Feature Map & Compute Match & Compute Gram 
         elif self.mode == 'capture_style':  #
-            style_fm = input.detach()
-            assert (style_fm.shape == self.content_fm.shape)
-            print('StyleLoss captured style feature map with shape {} '.format(str(style_fm.shape)))
-
-            # Compute Match 
-            print('StyleLoss Compute Match Relaiton between content fm & style fm')
-            correspond_fm, correspond_idx = self.match_fm(self.content_fm, style_fm)
-            
-            # Compute Gram Matrix 
-            print('StyleLoss Compute Gram Matrix')
-            #self.G = self.gram(torch.mul(correspond_fm, self.loss_mask)) / torch.sum(self.loss_mask)
-            self.G = self.gram(torch.mul(correspond_fm, self.loss_mask))
-            self.target = self.G.detach()
-
-            del self.content_fm
-            del style_fm
+            self.style_fm = input.detach()
+            assert (self.style_fm.shape == self.content_fm.shape)
+            print('StyleLoss captured style feature map with shape {} '.format(str(self.style_fm.shape)))
+
+            if not self.coarse_to_fine:
+                self.compute_target()
 
         # Step 3 : during updateing image 
         elif self.mode == 'loss':
             # self.G = self.gram(input)
             # self.G = self.G / input.nelement()
             # self.loss = self.critertain(self.G, self.target) * self.weight
-            self.G = self.gram(torch.mul(input, self.loss_mask)) 
-            self.loss = F.mse_loss(self.G, self.target) / self.loss_mask_sum * self.weight
+            # Gram, MSE & gradient mask (Return Gradient only over masked region) in one fused function, no hook per iteration
+            output, self.loss = MaskedGramMSELoss.apply(input, self.gram, self.target, self.weight / self.loss_mask_sum, self.loss_mask)
+            return output
 
-            def backward_variable_gradient_mask_hook_fn(grad):
-                '''
-                Functionality : 
-                    Return Gradient only over masked region
-                Notice : 
-                    Variable hook is used in this case, Module hook is not supported for `complex moule` 
-                '''
-                return torch.mul(grad, self.loss_mask)
+        return input
 
-            input.register_hook(backward_variable_gradient_mask_hook_fn)
+    def compute_target(self, coarse_idx=None):
+        '''
+        Input :
+            coarse_idx : 2 * h * w, correspond_idx of the deeper layer. If given, only search around the guess it gives
+        Process:
+            compute match between captured content fm & style fm & compute style image gram matrix under masked region
+        Output:
+            correspond_idx : 2 * H * W, used to guide the match of the shallower layer
+        '''
+        # Compute Match 
+        print('StyleLoss Compute Match Relaiton between content fm & style fm')
+        correspond_fm, correspond_idx = self.match_fm(self.content_fm, self.style_fm, coarse_idx)
 
-        return input
+        # Compute Gram Matrix 
+        print('StyleLoss Compute Gram Matrix')
+        #self.G = self.gram(torch.mul(correspond_fm, self.loss_mask)) / torch.sum(self.loss_mask)
+        self.G = self.gram(correspond_fm)  # masked by self.gram
+        self.target = self.G.detach()
+
+        del self.content_fm
+        del self.style_fm
+
+        return correspond_idx
 
-    def match_fm(self, content_fm, style_fm):
+    def match_fm(self, content_fm, style_fm, coarse_idx=None):
         '''
         Input : 
             style_fm : 1 * C * H * W 
             content_fm : 1 * C * H * W
+            coarse_idx : 2 * h * w, correspond_idx of the deeper layer, see `compute_target`
         Process:
-            Instead of only compute the match for pixel inside the mask, here we compute the 
+            When `self.match_region == 'full'`, instead of only compute the match for pixel inside the mask, here we compute the 
                 match for the whole feature map and use mask to filter out the matched pixel we don't need 
-            Patch Match is done in convolution fashion where content image's fm patch is used as kernal and applied 
-                to the styled image fm, a score map will be computed (w.r.t each content fm location) and we construct the 
-                matched style feature map using the score map we get for each content fm patch 
-            After compute score map using covolutiopn, a normalization process is used to avoid overfloat and local maximal issue
+            When `self.match_region == 'mask'`, only location inside the loss mask is matched (see `match_positions`), 
+                the sparse match (positions, matched idx) is scattered back, location outside keep the style fm itself 
+            When `self.matcher == 'patchmatch'`, the exhaustive search is replaced by the approximate `match_patchmatch`
+            When `coarse_idx` is given, the match of the deeper layer is upsampled as a guess & refined inside a 
+                (2 * match_window + 1) ** 2 window, see `match_local_window` 
+            Patch Match is done in matrix multiplication fashion where all content fm patches & all style fm patches are 
+                unfolded into two patch banks, the score of every (content patch, style patch) pair is computed block by block 
+                (see `match_patch_bank`) and we construct the matched style feature map using the maximal score of each content fm patch 
+            A normalization process is used on score to avoid overfloat and local maximal issue
         
         Score Map Normalize Process:
             patch1 : 3 * 3 
@@ -469,13 +1112,13 @@ class StyleLossPass1(nn.Module):
         stride = self.stride
         patch_size = self.patch_size
         padding = (patch_size - 1) // 2
-        c1, h1, w1 = content_fm.shape[1], content_fm.shape[2], content_fm.shape[3]
-        c2, h2, w2 = style_fm.shape[1], style_fm.shape[2], style_fm.shape[3]
-        c, h, w = c1, h1, w1
+        h1, w1 = content_fm.shape[2], content_fm.shape[3]
+        h2, w2 = style_fm.shape[2], style_fm.shape[3]
+        h, w = h1, w1
 
         # It's not nessary for two feature map to share the same spatial dimention
-        # but in this project we enforce that for better quantititive result 
-        assert (content_fm.shape == style_fm.shape)
+        # but in this project we enforce that for better quantititive result, except tiled mode where a tile is matched with a larger style window 
+        assert (content_fm.shape[:2] == style_fm.shape[:2])
 
         n_patch_h = math.floor(h / stride)  # use math package to avoid potential python2 issue
         n_patch_w = math.floor(w / stride)
@@ -484,47 +1127,69 @@ class StyleLossPass1(nn.Module):
         content_fm_pad = F.pad(content_fm, (padding,) * 4,
                                mode='reflect')  # 1 * C * (H + 2 * padding) * (W + 2 * padding)
 
-        correspond_fm = style_fm.clone()  # 1 * C * H * W
+        correspond_fm = style_fm.clone() if style_fm.shape == content_fm.shape else torch.zeros_like(content_fm)  # 1 * C * H * W
         correspond_idx = torch.zeros((2, h, w))  # 2 * H * W where first layer is x, second layer is y
-
-        # Compute Style FM Norm 
-        style_fm_norm = style_fm_pad ** 2
-        kernal = torch.ones((1, c, patch_size, patch_size)).to(self.device)
-        style_fm_norm = F.conv2d(style_fm_norm, kernal, stride=stride, padding=0)
-        style_fm_norm = style_fm_norm ** 0.5  # 1 * C * H * W
-
-        # Compute Score Map for each location on content_fm
-        for i in range(n_patch_h):  # H (y)
-            for j in range(n_patch_w):  # W (x)
-
-                # Each kernal represent a patch in content fm 
-                kernal = content_fm_pad[:, :, i:i + patch_size, j:j + patch_size].clone()
-                kernal_norm = torch.sum(kernal ** 2) ** 0.5
-
-                # Compute score map for each content fm patch kernal 
-                score_map = F.conv2d(style_fm_pad, kernal, stride=stride, padding=0)  # 1 * C * H * W
-
-                # Normalize score map 
-                score_map = score_map / (kernal_norm * style_fm_norm + 1e-9)
-                score_map = score_map[0, 0, :, :]  # 1 * 1 * H * W -> H * W 
-
-                # Find Maximal idx of score map 
-                idx = torch.argmax(score_map).item()
-                matched_style_idx = (int(idx // score_map.shape[1]), int(idx % score_map.shape[1]))  # (y, x)
-
-                # Corresponding FM 
-                # Index into 4d Tensor : [b, c, y, x]
-                correspond_fm[:, :, i, j] = style_fm[:, :, matched_style_idx[0], matched_style_idx[1]]
-                correspond_idx[0, i, j] = matched_style_idx[0]
-                correspond_idx[1, i, j] = matched_style_idx[1]
+        correspond_idx[0] = torch.arange(h).view(h, 1).float()  # location not matched point to itself
+        correspond_idx[1] = torch.arange(w).view(1, w).float()
+
+        # Location to match, row-major index into the (n_patch_h, n_patch_w) grid
+        if self.match_region == 'mask':
+            positions = self.match_positions(n_patch_h, n_patch_w)
+            print('StyleLoss Match {} / {} location inside mask'.format(positions.shape[0], n_patch_h * n_patch_w))
+        else:
+            positions = None
+
+        if coarse_idx is not None:
+            assert (stride == 1)
+            init_h, init_w = upsample_match_idx(coarse_idx, n_patch_h, n_patch_w, h2, w2)
+            match_idx, n_style_w = match_local_window(content_fm_pad, style_fm_pad, n_patch_h, n_patch_w, init_h, init_w, patch_size=patch_size,
+                                                      radius=self.match_window, mem_budget=self.match_mem_budget, positions=positions)
+        elif self.matcher == 'patchmatch':
+            assert (stride == 1)
+            match_idx, n_style_w = match_patchmatch(content_fm_pad, style_fm_pad, n_patch_h, n_patch_w, patch_size=patch_size,
+                                                    n_iter=self.patchmatch_iter, mem_budget=self.match_mem_budget, positions=positions)
+        else:
+            match_idx, n_style_w = match_patch_bank(content_fm_pad, style_fm_pad, n_patch_h, n_patch_w, patch_size=patch_size,
+                                                    stride=stride, mem_budget=self.match_mem_budget, positions=positions)
+
+        if positions is None:
+            positions = torch.arange(n_patch_h * n_patch_w, device=content_fm.device)
+
+        # Scatter sparse match (positions, match_idx) back
+        pos_h, pos_w = positions // n_patch_w, positions % n_patch_w
+        matched_style_h = match_idx // n_style_w  # (y)
+        matched_style_w = match_idx % n_style_w  # (x)
+
+        # Corresponding FM
+        # Index into 4d Tensor : [b, c, y, x]
+        correspond_fm[:, :, pos_h, pos_w] = style_fm[:, :, matched_style_h, matched_style_w]
+        correspond_idx[0, pos_h.cpu(), pos_w.cpu()] = matched_style_h.cpu().float()
+        correspond_idx[1, pos_h.cpu(), pos_w.cpu()] = matched_style_w.cpu().float()
 
         assert (correspond_fm.shape == content_fm.shape)
 
         return correspond_fm, correspond_idx  # 1 * C * H * W, 2 * H * W (first channel is x)
 
+    def match_positions(self, n_patch_h, n_patch_w):
+        '''
+        Output:
+            positions : N LongTensor, row-major index of location where the loss mask is nonzero, 
+                        the mask is grown by `self.match_mask_dilate` pixel first
+        '''
+        mask = self.loss_mask[:, :1, :n_patch_h, :n_patch_w]
+        if self.match_mask_dilate > 0:
+            k = 2 * self.match_mask_dilate + 1
+            mask = F.max_pool2d(mask, kernel_size=k, stride=1, padding=self.match_mask_dilate)
+        return torch.nonzero(mask.reshape(-1)).view(-1)
+
 class StyleLossPass2(StyleLossPass1):
-    def __init__(self, device, dtype, weight, loss_mask, match_patch_size, stride):
-        super(StyleLossPass2, self).__init__(device, dtype, weight, loss_mask, match_patch_size, stride)
+    # Spatial consistency step look at the match of the 3 * 3 neighbor, so they need to be matched as well
+    match_mask_dilate = 1
+
+    def __init__(self, device, dtype, weight, loss_mask, match_patch_size, stride, match_mem_budget=256, match_region='full',
+                 matcher='exact', patchmatch_iter=5, coarse_to_fine=False, match_window=2, gram_symmetric=False):
+        super(StyleLossPass2, self).__init__(device, dtype, weight, loss_mask, match_patch_size, stride, match_mem_budget, match_region,
+                                             matcher, patchmatch_iter, coarse_to_fine, match_window, gram_symmetric)
         self.ref_corr = None
         self.style_fm_matched = None
 
@@ -547,7 +1212,7 @@ class StyleLossPass2(StyleLossPass1):
             self.ref_corr, self.style_fm_matched = self.match_fm_ref(style_fm, self.content_fm)
 
             # Compute Gram Matrix
-            self.target_gram = self.gram(torch.mul(self.style_fm_matched, self.loss_mask))
+            self.target_gram = self.gram(self.style_fm_matched)  # masked by self.gram
 
         # Step 3: Capture Style Feature Map & Compute Match & Compute Gram for other layers
         elif self.mode == 'capture_style_others':
@@ -558,12 +1223,13 @@ class StyleLossPass2(StyleLossPass1):
             style_fm = input.detach()
             _, _, curr_H, curr_W = input.shape
             _, self.style_fm_matched = self.upsample_corr(self.ref_corr, curr_H, curr_W, style_fm)
-            self.target_gram = self.gram(torch.mul(self.style_fm_matched, self.loss_mask)) 
+            self.target_gram = self.gram(self.style_fm_matched)  # masked by self.gram
 
         # Step 4 : during updateing image
         elif self.mode == 'loss':
-            self.img_gram = self.gram(torch.mul(input, self.loss_mask)) 
-            self.loss = F.mse_loss(self.img_gram, self.target_gram) * self.weight / self.loss_mask_sum
+            # Gram & MSE in one fused function, no gradient mask in pass2. Input itself is passed on, so a histogram loss 
+            # hook on the same layer also mask the style loss gradient 
+            _, self.loss = MaskedGramMSELoss.apply(input, self.gram, self.target_gram, self.weight / self.loss_mask_sum, None)
 
         return input
 
@@ -574,7 +1240,7 @@ class StyleLossPass2(StyleLossPass1):
             img_fm: 1 * C * H * W, reference layer content feature map
 
         Output:
-            ref_corr: H * W, reference layer mapping,
+            ref_corr: H * W LongTensor, reference layer mapping,
                       ref_corr[i, j] is the index of patch in style_fm (ref layer)
                       which matches the i_th row and j_th col patch in img_fm (ref layer)
             style_fm_masked : 1 * C * H * W
@@ -591,77 +1257,70 @@ class StyleLossPass2(StyleLossPass1):
         padding_style_fm = F.pad(style_fm, [padding, padding, padding, padding], mode='reflect') # original paper use 0 pad, reflect pad make more sense in reality 
 
         # nearest neighbor index for ref_layer: H_ref * W_ref, same as P_out in paper
-        ref_corr = np.zeros((ref_h, ref_w))  # Output
+        ref_corr = torch.zeros((ref_h, ref_w), dtype=torch.long, device=style_fm.device)  # Output
 
         # Step 1: Find matches for the reference layer.
         _, corr_tmp = super().match_fm(img_fm, style_fm)
 
-        # Step 2: Enforce spatial consistency.
-        for i in range(n_patch_h):
-            for j in range(n_patch_w):
-                # Initialize a set of candidate style patches.
-                candidate_set = set()
-
-                # For all adjacent patches, look up the corresponding style patch.
-                for di in [-1, 0, 1]:
-                    for dj in [-1, 0, 1]:
-                        # skip if out of bounds
-                        if i + di < 0 or i + di >= n_patch_h or j + dj < 0 or j + dj >= n_patch_w:
-                            continue
-
-                        patch_idx = corr_tmp[:, i + di, j + dj]  # index of neighbor patch in style feature map
-                        patch_pos = (patch_idx[0] - di, patch_idx[1] - dj)
-
-                        # skip if out of bounds
-                        if patch_pos[0] < 0 \
-                                or patch_pos[0] >= n_patch_h \
-                                or patch_pos[1] < 0 \
-                                or patch_pos[1] >= n_patch_w:
-                            continue
-
-                        candidate_set.add((patch_pos[0], patch_pos[1]))
-
-                # Select the candidate the most similar to the style patches
-                # associated to the neighbors of p.
-                min_sum = np.inf
-                for c_h, c_w in candidate_set:
-                    style_fm_ref_c = get_patch(padding_style_fm, c_h, c_w,
-                                               patch_size)  # get patch from style_fm at (c_h, c_w)
-                    sum = 0
-
-                    for di in [-1, 0, 1]:
-                        for dj in [-1, 0, 1]:
-                            # skip if out of bounds
-                            if i + di < 0 or i + di >= n_patch_h or j + dj < 0 or j + dj >= n_patch_w:
-                                continue
-
-                            patch_idx = corr_tmp[:, i + di, j + dj]
-                            patch_pos = (patch_idx[0], patch_idx[1])
-
-                            # skip if out of bounds
-                            if patch_pos[0] < 0 \
-                                    or patch_pos[0] >= n_patch_h \
-                                    or patch_pos[1] < 0 \
-                                    or patch_pos[1] >= n_patch_w:
-                                continue
-
-                            # get patch from style_fm at (patch_pos[0], patch_pos[1])
-                            style_fm_ref_p = get_patch(padding_style_fm, patch_pos[0], patch_pos[1], patch_size)
-                            sum += F.conv2d(style_fm_ref_c, style_fm_ref_p).item()
-
-                    if sum < min_sum:
-                        min_sum = sum
-                        ref_corr[i, j] = c_h * n_patch_w + c_w
+        # Step 2: Enforce spatial consistency, done for all location at once.
+        # For location p & each of its 3 * 3 neighbor q (offset d), the candidate is the match of q shifted back by d.
+        # Each candidate is scored by the sum of its similarity (dot product) with the style patch matched
+        # by every neighbor, and the candidate with minimal sum is kept
+        device = style_fm.device
+        corr_h = corr_tmp[0, :n_patch_h, :n_patch_w].long().to(device)
+        corr_w = corr_tmp[1, :n_patch_h, :n_patch_w].long().to(device)
+        style_bank = extract_patches(padding_style_fm, patch_size, 1).contiguous()  # (ref_h * ref_w) * (C * patch_size * patch_size)
+
+        pos_h = torch.arange(n_patch_h, device=device).view(-1, 1).expand(n_patch_h, n_patch_w).reshape(-1)
+        pos_w = torch.arange(n_patch_w, device=device).view(1, -1).expand(n_patch_h, n_patch_w).reshape(-1)
+
+        cand_idx, cand_valid, neighbor_idx, neighbor_valid = [], [], [], []
+        for di in [-1, 0, 1]:
+            for dj in [-1, 0, 1]:
+                # skip if out of bounds
+                inside = (pos_h + di >= 0) & (pos_h + di < n_patch_h) & (pos_w + dj >= 0) & (pos_w + dj < n_patch_w)
+                patch_h = corr_h[(pos_h + di).clamp(0, n_patch_h - 1), (pos_w + dj).clamp(0, n_patch_w - 1)]
+                patch_w = corr_w[(pos_h + di).clamp(0, n_patch_h - 1), (pos_w + dj).clamp(0, n_patch_w - 1)]
+
+                # index of neighbor patch in style feature map
+                neighbor_valid.append(inside & (patch_h >= 0) & (patch_h < n_patch_h) & (patch_w >= 0) & (patch_w < n_patch_w))
+                neighbor_idx.append(patch_h.clamp(0, ref_h - 1) * ref_w + patch_w.clamp(0, ref_w - 1))
+
+                # candidate, neighbor patch shifted back to p
+                cand_h, cand_w = patch_h - di, patch_w - dj
+                cand_valid.append(inside & (cand_h >= 0) & (cand_h < n_patch_h) & (cand_w >= 0) & (cand_w < n_patch_w))
+                cand_idx.append(cand_h.clamp(0, n_patch_h - 1) * n_patch_w + cand_w.clamp(0, n_patch_w - 1))
+
+        cand_idx, cand_valid = torch.stack(cand_idx, 1), torch.stack(cand_valid, 1)  # (n_patch_h * n_patch_w) * 9
+        neighbor_idx, neighbor_valid = torch.stack(neighbor_idx, 1), torch.stack(neighbor_valid, 1)  # (n_patch_h * n_patch_w) * 9
+
+        # Score every (candidate, neighbor) pair with one batched dot product, chunked to fit the memory budget
+        n_pos = cand_idx.shape[0]
+        chunk = max(1, int(self.match_mem_budget * 2 ** 20) // (18 * style_bank.element_size() * style_bank.shape[1]))
+        best = torch.zeros((n_pos,), dtype=torch.long, device=device)
+        for start in range(0, n_pos, chunk):
+            end = min(start + chunk, n_pos)
+            cand_patch = style_bank[cand_idx[start:end]]  # n * 9 * D
+            neighbor_patch = style_bank[neighbor_idx[start:end]]  # n * 9 * D
+            dot = torch.bmm(cand_patch, neighbor_patch.transpose(1, 2)).double()  # n * 9 (candidate) * 9 (neighbor)
+
+            # Accumulate neighbor one by one (same order as a python loop over neighbor)
+            score = torch.zeros(dot.shape[:2], dtype=torch.float64, device=device)
+            for k in range(9):
+                score += dot[:, :, k] * neighbor_valid[start:end, k:k + 1]
+            score[~cand_valid[start:end]] = float('inf')
+
+            # First candidate with minimal score win
+            best[start:end] = torch.argmin(score, 1)
+
+        ref_corr[:n_patch_h, :n_patch_w] = cand_idx.gather(1, best.view(-1, 1)).view(n_patch_h, n_patch_w)
 
         # Step 3: Create style_fm_matched based on ref_corr
         style_fm_matched = style_fm.clone()
-        for i in range(n_patch_h):
-            for j in range(n_patch_w):
-                # Find matched index in style fm
-                matched_style_idx = (int(ref_corr[i, j]) // ref_w, int(ref_corr[i, j]) % ref_w) #  1 * C * 3 * 3
-                style_fm_matched[:, :, i, j] = style_fm[:, :, matched_style_idx[0], matched_style_idx[1]]
+        matched_h, matched_w = ref_corr[:n_patch_h, :n_patch_w] // ref_w, ref_corr[:n_patch_h, :n_patch_w] % ref_w
+        style_fm_matched[:, :, :n_patch_h, :n_patch_w] = style_fm[:, :, matched_h, matched_w]
 
-        return ref_corr.astype(np.int), style_fm_matched
+        return ref_corr, style_fm_matched
 
     def upsample_corr(self, ref_corr, curr_h, curr_w, style_fm):
         '''
@@ -674,36 +1333,230 @@ class StyleLossPass2(StyleLossPass1):
             style_fm : 1 * C * H * W
 
         Output:
-            curr_corr: curr_h * curr_w, curr layer mapping,
+            curr_corr: curr_h * curr_w IntTensor, curr layer mapping,
                        curr_corr[i, j] is the index of patch in style_fm (current layer)
                        which matches the i_th row and j_th col patch in img_fm_curr (current layer)
             style_fm_masked : 1 * C * H * W
         '''
 
-        # curr_corr = F.interpolate(torch.from_numpy(ref_corr), size=(curr_h, curr_w))
-        # return curr_corr
-        curr_corr = np.zeros((curr_h, curr_w))
+        # Computed for the whole grid at once, float64 keep the same rounding as python float
+        ref_corr = torch.as_tensor(ref_corr, device=style_fm.device).long()
         ref_h, ref_w = ref_corr.shape
 
         h_ratio = curr_h / ref_h
         w_ratio = curr_w / ref_w
 
-        style_fm_matched = style_fm.clone()
+        curr_i = torch.arange(curr_h, dtype=torch.float64, device=style_fm.device)
+        curr_j = torch.arange(curr_w, dtype=torch.float64, device=style_fm.device)
+
+        # Location in ref layer each current location fall into
+        ref_i = ((curr_i + 0.4999) // h_ratio).clamp(0, ref_h - 1).long()
+        ref_j = ((curr_j + 0.4999) // w_ratio).clamp(0, ref_w - 1).long()
+
+        ref_mapping_idx = ref_corr[ref_i][:, ref_j]  # curr_h * curr_w
+        ref_mapping_i, ref_mapping_j = ref_mapping_idx // ref_w, ref_mapping_idx % ref_w
+
+        # Shift current location by the ref layer offset (scaled to current layer), .long() truncate like int()
+        curr_mapping_i = (curr_i.view(-1, 1) + (ref_mapping_i - ref_i.view(-1, 1)).double() * h_ratio + 0.4999).long()
+        curr_mapping_j = (curr_j.view(1, -1) + (ref_mapping_j - ref_j.view(1, -1)).double() * w_ratio + 0.4999).long()
+        curr_corr = curr_mapping_i.clamp(0, curr_h - 1) * curr_w + curr_mapping_j.clamp(0, curr_w - 1)
+
+        # Single gather on the flattened style feature map
+        B, C = style_fm.shape[0], style_fm.shape[1]
+        style_fm_matched = style_fm.reshape(B, C, -1).index_select(2, curr_corr.view(-1)).view(B, C, curr_h, curr_w)
+
+        return curr_corr.int(), style_fm_matched
+
+
+class BatchedLoss(nn.Module):
+    '''
+    Functionality : 
+        loss module of N job at the same position of the net, sample n of the batch is passed to loss module n 
+    '''
+    def __init__(self, loss_modules):
+        super(BatchedLoss, self).__init__()
+        self.loss_modules = nn.ModuleList(loss_modules)
+
+    def forward(self, input):
+        return torch.cat([module(input[n:n + 1]) for n, module in enumerate(self.loss_modules)], dim=0)
 
-        for i in range(curr_h):
-            for j in range(curr_w):
-                ref_idx = [(i + 0.4999) // h_ratio, (j + 0.4999) // w_ratio]
-                ref_idx[0] = int(max(min(ref_idx[0], ref_h - 1), 0))
-                ref_idx[1] = int(max(min(ref_idx[1], ref_w - 1), 0))
 
-                ref_mapping_idx = ref_corr[ref_idx[0], ref_idx[1]]
-                ref_mapping_idx = (ref_mapping_idx // ref_w, ref_mapping_idx % ref_w)
+def batch_net(nets):
+    '''
+    Input : 
+        nets : list of net from build_net (with target captured), one for each job 
+    Return : 
+        nn.Sequential that run backbone layer once over N * 3 * H * W input & each loss layer per sample 
+    Notice : 
+        all net must have the same loss layers, backbone layer of nets[0] is used 
+    '''
+    assert all(len(net) == len(nets[0]) for net in nets), 'batch job must have the same loss layers'
+
+    net = nn.Sequential()
+    for layers in zip(*nets):
+        assert all(type(layer) == type(layers[0]) for layer in layers), 'batch job must have the same loss layers'
+        if isinstance(layers[0], (nn.Conv2d, nn.ReLU, nn.MaxPool2d, nn.AvgPool2d)):
+            net.add_module(str(len(net)), layers[0])
+        else:
+            net.add_module(str(len(net)), BatchedLoss(layers))
+    return net
 
-                curr_mapping_idx = (int(i + (ref_mapping_idx[0] - ref_idx[0]) * h_ratio + 0.4999),
-                                    int(j + (ref_mapping_idx[1] - ref_idx[1]) * w_ratio + 0.4999))
-                curr_corr[i, j] = curr_mapping_idx[0] * curr_w + curr_mapping_idx[1]
 
-                #  1 * C * 3 * 3
-                style_fm_matched[:, :, i, j] = style_fm[:, :, curr_mapping_idx[0], curr_mapping_idx[1]]
+class IncrementalNet(nn.Module):
+    '''
+    Functionality : 
+        wrap the `nn.Sequential` of build_net, cache conv / pool output of the last forward and on the next forward only 
+        recompute the region that can see a changed pixel (or a pixel that need gradient), splice it into the cache 
+    Input : 
+        net : nn.Sequential of Conv2d / ReLU / MaxPool2d / AvgPool2d & shape preserving (loss) modules 
+        grad_mask : 1 * 1 * H * W, pixel with nonzero value is always treated as changed so its gradient is complete 
+        max_dirty : if dirty region cover more than this portion of image, run full forward 
+    Notice : 
+        1. loss module always see the whole (spliced) feature map, so loss is the same as a full forward 
+        2. activation outside dirty region do not depend on any dirty pixel, so gradient over dirty region is the same as a full forward 
+        3. use a new wrapper (or call reset) whenever net weight / loss target change 
+    '''
+    def __init__(self, net, grad_mask=None, max_dirty=0.5):
+        super(IncrementalNet, self).__init__()
+        self.net = net
+        self.grad_mask = None
+        if grad_mask is not None:
+            self.grad_mask = (grad_mask != 0).any(dim=0).any(dim=0)  # H * W
+        self.max_dirty = max_dirty
+        self.reset()
+
+    def reset(self):
+        self.cache_input = None
+        self.cache = {}
 
-        return curr_corr, style_fm_matched
+    def forward(self, input):
+        region = self.dirty_region(input)
+        self.cache_input = input.detach().clone()
+
+        if region is None:
+            return self.full_forward(input)
+
+        x = input
+        for i, layer in enumerate(self.net):
+            if isinstance(layer, (nn.Conv2d, nn.MaxPool2d, nn.AvgPool2d)):
+                x, region = self.region_forward(i, layer, x, region)
+            elif isinstance(layer, nn.ReLU):
+                x = F.relu(x)  # not inplace, cache must not be modified 
+            else:
+                x = layer(x)
+        return x
+
+    def full_forward(self, input):
+        x = input
+        for i, layer in enumerate(self.net):
+            if isinstance(layer, nn.ReLU):
+                x = F.relu(x)
+            else:
+                x = layer(x)
+            if isinstance(layer, (nn.Conv2d, nn.MaxPool2d, nn.AvgPool2d)):
+                self.cache[i] = x.detach()
+        return x
+
+    def dirty_region(self, input):
+        '''
+        Return : 
+            (y0, y1, x0, x1) bounding box of changed pixel & grad_mask, None if full forward is needed 
+        '''
+        if self.cache_input is None or self.cache_input.shape != input.shape:
+            return None
+
+        dirty = (input.detach() != self.cache_input).any(dim=0).any(dim=0)
+        if self.grad_mask is not None:
+            dirty = dirty | self.grad_mask
+
+        nonzero = torch.nonzero(dirty)
+        if nonzero.shape[0] == 0:
+            return None
+        y0, x0 = nonzero.min(dim=0)[0].tolist()
+        y1, x1 = (nonzero.max(dim=0)[0] + 1).tolist()
+
+        if (y1 - y0) * (x1 - x0) > self.max_dirty * dirty.nelement():
+            return None
+        return y0, y1, x0, x1
+
+    def region_forward(self, i, layer, x, region):
+        '''
+        Process : 
+            1. output region that has a window overlap input region 
+            2. input window (plus padding) of output region, outside of image is padded 
+            3. run layer without padding over the window, splice into cached output 
+        '''
+        k, s, p, d = [v if isinstance(v, int) else v[0] for v in (layer.kernel_size, layer.stride, layer.padding, getattr(layer, 'dilation', 1))]
+        H, W = x.shape[2], x.shape[3]
+        cache = self.cache[i]
+        out_H, out_W = cache.shape[2], cache.shape[3]
+        y0, y1, x0, x1 = region
+
+        def out_range(lo, hi, size):
+            return max(0, -(((k - 1) * d - p - lo) // s)), min(size, (hi - 1 + p) // s + 1)
+
+        oy0, oy1 = out_range(y0, y1, out_H)
+        ox0, ox1 = out_range(x0, x1, out_W)
+
+        iy0, iy1 = oy0 * s - p, (oy1 - 1) * s - p + (k - 1) * d + 1
+        ix0, ix1 = ox0 * s - p, (ox1 - 1) * s - p + (k - 1) * d + 1
+        window = x[:, :, max(0, iy0):min(H, iy1), max(0, ix0):min(W, ix1)]
+        pad = (max(0, -ix0), max(0, ix1 - W), max(0, -iy0), max(0, iy1 - H))
+
+        if isinstance(layer, nn.Conv2d):
+            window = F.pad(window, pad)
+            out = F.conv2d(window, layer.weight, layer.bias, s, 0, d, layer.groups)
+        elif isinstance(layer, nn.MaxPool2d):
+            window = F.pad(window, pad, value=-float('inf'))
+            out = F.max_pool2d(window, k, s, 0, d)
+        else:
+            window = F.pad(window, pad)
+            out = F.avg_pool2d(window, k, s, 0)
+
+        output = cache.clone()
+        output[:, :, oy0:oy1, ox0:ox1] = out
+        self.cache[i] = output.detach()
+
+        return output, (oy0, oy1, ox0, ox1)
+
+
+class CheckpointNet(nn.Module):
+    '''
+    Functionality : 
+        wrap the `nn.Sequential` of build_net, backbone layers between two loss module run as one checkpointed segment. 
+        Activation inside a segment is dropped after forward & recomputed during backward, only segment boundary 
+        (input of loss module) is kept alive 
+    Input : 
+        net : nn.Sequential of Conv2d / ReLU / MaxPool2d / AvgPool2d & (loss) modules 
+    Notice : 
+        1. loss module run outside checkpoint, so loss & hook are only computed once per forward 
+        2. ReLU run out of place, inplace ReLU would overwrite the saved input of a segment before recompute 
+    '''
+    def __init__(self, net):
+        super(CheckpointNet, self).__init__()
+        self.net = net
+
+        # list of (is_backbone, [layer]) 
+        self.segments = []
+        for layer in net:
+            is_backbone = isinstance(layer, (nn.Conv2d, nn.ReLU, nn.MaxPool2d, nn.AvgPool2d))
+            if is_backbone and self.segments and self.segments[-1][0]:
+                self.segments[-1][1].append(layer)
+            else:
+                self.segments.append((is_backbone, [layer]))
+
+    @staticmethod
+    def run_segment(layers, x):
+        for layer in layers:
+            x = F.relu(x) if isinstance(layer, nn.ReLU) else layer(x)
+        return x
+
+    def forward(self, input):
+        x = input
+        for is_backbone, layers in self.segments:
+            if is_backbone and x.requires_grad:
+                x = checkpoint(self.run_segment, layers, x, use_reentrant=False)
+            else:
+                for layer in layers:
+                    x = layer(x)
+        return x
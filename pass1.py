@@ -15,10 +15,13 @@ from utils import *
 if not os.path.exists('output'):
     os.makedirs('output')
 
-def train(cfg, device, dtype, net, tight_mask, loss_mask, optim_img, content_loss_list, style_loss_list, tv_loss_list, histogram_loss_list):
+def train(cfg, device, dtype, net, tight_mask, loss_mask, optim_img, content_loss_list, style_loss_list, tv_loss_list, histogram_loss_list, samples=None, resume_state=None):
     '''
     Input:
         optim_img (Tensor) : image that used for update. In pass1, updated_img = content_img. In pass1, update_img = pass1 output 
+        samples : batch mode only, list of (cfg, content_loss_list, style_loss_list, tv_loss_list, histogram_loss_list) of each job, 
+                  used to print loss & save image per job 
+        resume_state : from load_checkpoint, continue from the saved iteration, capture must be skipped by the caller 
     '''
     
     print('\n===> Start Updating Image')
@@ -27,110 +30,154 @@ def train(cfg, device, dtype, net, tight_mask, loss_mask, optim_img, content_los
     net = net.to(device).eval()
     for param in net.parameters():
         param.requires_grad = False
+
+    # Only recompute the feature map around the updated region after the first iteration 
+    assert(not (cfg.incremental and cfg.grad_checkpoint)), '-incremental & -grad_checkpoint can not be used together'
+    if cfg.incremental:
+        net = IncrementalNet(net, grad_mask=loss_mask, max_dirty=cfg.incremental_max_dirty)
+
+    # Recompute activation between loss layer during backward 
+    if cfg.grad_checkpoint:
+        net = CheckpointNet(net)
+
+    if torch.device(device).type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
     
-    # Set img gradient to be true to update image 
-    img = optim_img.clone()
-    img = nn.Parameter(optim_img)
-
-    # Keep track of loss 
-    content_loss_his = []
-    style_loss_his = []
-    tv_loss_his = []
-    histogram_loss_his = []
-
-    def periodic_print(i_iter, c_loss, s_loss, tv_loss, h_loss, total_loss):
-        if i_iter % cfg.print_interval == 0:
-            if cfg.tv_weight > 0:
-                tv_loss = tv_loss.item()
-            if cfg.histogram_weight > 0:
-                h_loss = h_loss.item()
-            if cfg.verbose:
-                print('Iteration {:06d}; Total Loss {:.06f}; Content Loss {:.06f}; Style Loss {:.06f}; \
-TV Loss {:.06f}; Histogram Loss {:.06f}'.format(i_iter, total_loss, c_loss.item(), s_loss.item(), tv_loss, h_loss))
-            '''
-            for i, module in enumerate(content_loss_list):
-                print("  Content " + str(i+1) + " loss: " + str(module.loss.item()))
-            for i, module in enumerate(style_loss_list):
-                print("  Style " + str(i+1) + " loss: " + str(module.loss.item()))     
-            if cfg.histogram_weight > 0:
-                for i, module in enumerate(histogram_loss_list):
-                    print("  Histogram " + str(i+1) + " loss: " + str(module.loss.item()))
-            if cfg.tv_weight > 0:
-                for i, module in enumerate(tv_loss_list):
-                    print("  Total Variance " + str(i+1) + " loss: " + str(module.loss.item()))
-            '''
-
-    def periodic_save_img(i_iter):
-        flag = (i_iter % cfg.save_img_interval == 0) or (i_iter == cfg.n_iter)
+    # Set img gradient to be true to update image, optimize a copy so optim_img (also used as target) is kept 
+    img = nn.Parameter(optim_img.clone())
+
+    # Keep track of loss of every loss layer, batch mode prefix the name with job 
+    job_lists = [(None, [content_loss_list, style_loss_list, tv_loss_list, histogram_loss_list])] if samples is None else [(n, sample[1:]) for n, sample in enumerate(samples)]
+    loss_modules, loss_names = [], []
+    for n, loss_lists in job_lists:
+        for kind, loss_list in zip(['content', 'style', 'tv', 'histogram'], loss_lists):
+            for k, module in enumerate(loss_list):
+                loss_modules.append(module)
+                loss_names.append(('' if n is None else 'job{}_'.format(n)) + '{}_{}'.format(kind, k + 1))
+    history = LossHistory(loss_names, device)
+
+    def periodic_print(i_iter):
+        if i_iter % cfg.print_interval == 0 and cfg.verbose:
+            c_loss, s_loss, tv_loss, h_loss = [history.summary(kind)[-1] for kind in ['content', 'style', 'tv', 'histogram']]
+            print('Iteration {:06d}; Total Loss {:.06f}; Content Loss {:.06f}; Style Loss {:.06f}; \
+TV Loss {:.06f}; Histogram Loss {:.06f}'.format(i_iter, c_loss + s_loss + tv_loss + h_loss, c_loss, s_loss, tv_loss, h_loss))
+            if samples is not None:
+                for n in range(len(samples)):
+                    print('  Job {:d}; Content Loss {:.06f}; Style Loss {:.06f}; TV Loss {:.06f}; Histogram Loss {:.06f}'.format(
+                        n, *[history.summary(kind, n)[-1] for kind in ['content', 'style', 'tv', 'histogram']]))
+
+    # Image is saved in background thread 
+    writer = SnapshotWriter()
+
+    def periodic_save_img(i_iter, final=False, suffix=''):
+        flag = snapshot_due(cfg, i_iter) or final
         if flag:
             print('Iteration {:06d} Save Image'.format(i_iter))
-            output_filename, file_extension = os.path.splitext(cfg.output_img)
-            if i_iter == cfg.n_iter:
-                filename = str(output_filename) + str(file_extension)
-            else:
-                filename = str(output_filename) + "_iter_{:06d}".format(i_iter) + str(file_extension)
-            img_deprocessed = img_deprocess(img.clone())
-            img_deprocessed.save(str(filename))
+            output_imgs = [cfg.output_img] if samples is None else [sample[0].output_img for sample in samples]
+            for n, output_img in enumerate(output_imgs):
+                output_filename, file_extension = os.path.splitext(output_img)
+                if i_iter == cfg.n_iter or final:
+                    filename = str(output_filename) + suffix + str(file_extension)
+                else:
+                    filename = str(output_filename) + "_iter_{:06d}".format(i_iter) + str(file_extension)
+                writer.save(img[n:n + 1], filename)
     
-    def periodic_save_loss(i_iter, c_loss, s_loss, tv_loss, h_loss):
-        if i_iter % 10 == 0:
-            if cfg.tv_weight > 0:
-                tv_loss = tv_loss.item()
-            if cfg.histogram_weight > 0:
-                h_loss = h_loss.item()
-            content_loss_his.append(c_loss.item())
-            style_loss_his.append(s_loss.item())
-            tv_loss_his.append(tv_loss)
-            histogram_loss_his.append(h_loss)
-
-    # Build optimizer and run optimizer
+    # Relative change of total loss over the last `cfg.converge_window` iteration, checked every `cfg.converge_window` iteration 
+    converged = False
+
+    def check_converge(i_iter):
+        nonlocal converged
+        if cfg.converge_tol <= 0 or i_iter == 0 or i_iter % cfg.converge_window != 0:
+            return
+        total_loss = history.fetch().sum(1)
+        change = abs(total_loss[i_iter - cfg.converge_window] - total_loss[i_iter]) / max(abs(total_loss[i_iter - cfg.converge_window]), 1e-12)
+        converged = change < cfg.converge_tol
+
+    # Build optimizer and run optimizer, i_iter count closure evaluation 
     def closure():
+        nonlocal i_iter
 
         optimizer.zero_grad()
         _ = net(img)
 
-        c_loss = 0
-        s_loss = 0
-        tv_loss = 0
-        h_loss = 0
-        total_loss = 0
-
-        for i in content_loss_list:
-            c_loss += i.loss.to(device)
-        for i in style_loss_list:
-            s_loss += i.loss.to(device)
-        if cfg.tv_weight > 0:
-            for i in tv_loss_list:
-                tv_loss += i.loss.to(device)
-        if cfg.histogram_weight > 0: # For pass1, this part is not used
-            for i in histogram_loss_list:
-                h_loss += i.loss.to(device)
-
-        total_loss = s_loss + c_loss + tv_loss + h_loss 
-        total_loss.backward(retain_graph=True)
+        # Loss stay on device, history is only copied to host at print / converge check 
+        losses = [i.loss for i in loss_modules]
+        total_loss = sum(losses)
+        total_loss.backward()
 
         # Only update img over masked region 
         img.grad = torch.mul(img.grad, loss_mask.expand_as(img))
 
-        periodic_print(i_iter, c_loss, s_loss, tv_loss, h_loss, total_loss)
+        history.record(losses)
+        periodic_print(i_iter)
         periodic_save_img(i_iter)
-        periodic_save_loss(i_iter, c_loss, s_loss, tv_loss, h_loss)
+        check_converge(i_iter)
+        i_iter += 1
 
         return total_loss
 
-    optimizer = torch.optim.Adam([img], cfg.lr)
+    optimizer = build_optimizer(cfg, img)
     i_iter = 0
-    while i_iter <= cfg.n_iter:
-        optimizer.step(closure)
-        i_iter += 1
+
+    # Continue from checkpoint, captured target of loss module is restored instead of recomputed 
+    if resume_state is not None:
+        assert(resume_state['img'].shape == img.shape and len(resume_state['loss_modules']) == len(loss_modules)), 'checkpoint does not match current option'
+        img.data.copy_(resume_state['img'])
+        optimizer.load_state_dict(resume_state['optimizer'])
+        history.restore(resume_state['history'])
+        for module, state in zip(loss_modules, resume_state['loss_modules']):
+            load_loss_module_state(module, state)
+        i_iter, converged = resume_state['i_iter'], resume_state['converged']
+        print('Resume at Iteration {:06d}'.format(i_iter))
+
+    # A L-BFGS step can take more than one iteration, so checkpoint once an interval boundary is passed 
+    last_checkpoint = i_iter
+    try:
+        while i_iter <= cfg.n_iter and not converged:
+            if cfg.optim == 'lbfgs':
+                optimizer.param_groups[0]['max_iter'] = optimizer.param_groups[0]['max_eval'] = step_budget(cfg, i_iter)
+            optimizer.step(closure)
+            if cfg.checkpoint_interval > 0 and i_iter // cfg.checkpoint_interval > last_checkpoint // cfg.checkpoint_interval:
+                save_checkpoint(cfg, img, optimizer, i_iter, converged, history, loss_modules)
+                last_checkpoint = i_iter
+
+        if converged:
+            print('Iteration {:06d} Converged, relative loss change over {} iteration below {}'.format(i_iter - 1, cfg.converge_window, cfg.converge_tol))
+
+        # Saved after the last step, the last closure call can be a trial image of L-BFGS line search 
+        periodic_save_img(i_iter - 1, final=True)
+    except KeyboardInterrupt:
+        # Keep the current image before exit, not as output_img so an interrupted run is not taken as finished 
+        print('Iteration {:06d} Interrupted'.format(i_iter))
+        periodic_save_img(i_iter, final=True, suffix='_interrupted')
+        raise
+    finally:
+        writer.close()
+
+    # Final state, so resume after the run finished does not optimize again 
+    if cfg.checkpoint_interval > 0:
+        save_checkpoint(cfg, img, optimizer, i_iter, converged, history, loss_modules)
 
     time_elapsed = time.time() - start_time
     print('@ Time Spend {:.04f} m {:.04f} s'.format(time_elapsed // 60, time_elapsed % 60))
+    print('@ Peak Memory {:.1f} MB'.format(peak_memory(device)))
+
+    # Loss of every 10 iteration for plot, loss of every layer is saved if needed 
+    content_loss_his, style_loss_his, tv_loss_his, histogram_loss_his = [list(history.summary(kind)[::10]) for kind in ['content', 'style', 'tv', 'histogram']]
+    if cfg.save_loss_history:
+        output_filename, _ = os.path.splitext(cfg.output_img)
+        history.save(str(output_filename) + '_loss.json')
 
     return img, content_loss_his, style_loss_his, tv_loss_his, histogram_loss_his
 
 
-def build_net(cfg, device, dtype, tight_mask, loss_mask, StyleLoss, ContentLoss, TVLoss, HistogramLoss):
+def build_net(cfg, device, dtype, tight_mask, loss_mask, StyleLoss, ContentLoss, TVLoss, HistogramLoss, backbone=None, canvas_size=None):
+    '''
+    Input : 
+        backbone : (cnn, layer_list) from build_backbone, to share one loaded model across passes. Default load from cfg.model_file 
+        canvas_size : (H, W) of the whole image when image & mask are cropped to the roi, so histogram loss count the pixel 
+                      outside roi like on the whole canvas. None if not cropped 
+    '''
 
     print('\n===> Build Network with {} & Loss Module'.format(cfg.model))
 
@@ -144,8 +191,10 @@ def build_net(cfg, device, dtype, tight_mask, loss_mask, StyleLoss, ContentLoss,
     histogram_loss_list = [] # For pass1, will be empty list 
 
     # Build backbone 
-    cnn, layer_list = build_backbone(cfg)
-    cnn = copy.deepcopy(cnn)
+    if backbone is None:
+        backbone = build_backbone(cfg)
+    cnn, layer_list = backbone
+    cnn = copy.deepcopy(cnn, {id(param): param for param in cnn.parameters()}) # weight is shared with backbone, not copied 
 
     if cfg.verbose:
         print('\n===> Build Backbone Network with {}'.format(cfg.model))
@@ -172,6 +221,9 @@ def build_net(cfg, device, dtype, tight_mask, loss_mask, StyleLoss, ContentLoss,
                 loss_mask = sap(loss_mask)
 
             elif isinstance(layer, nn.ReLU):
+                # Output of a pass1 style loss is the output of a custom function, which can not be modified inplace 
+                if len(net) > 0 and isinstance(net[-1], StyleLossPass1):
+                    layer = nn.ReLU(inplace=False)
                 net.add_module(str(len(net)), layer)
 
             elif isinstance(layer, nn.MaxPool2d) or isinstance(layer, nn.AvgPool2d):
@@ -180,6 +232,8 @@ def build_net(cfg, device, dtype, tight_mask, loss_mask, StyleLoss, ContentLoss,
                 # Scale the mask into the corresponding spatial size
                 loss_mask = F.interpolate(loss_mask, scale_factor=(0.5, 0.5))  
                 tight_mask = F.interpolate(tight_mask, scale_factor=(0.5, 0.5))  
+                if canvas_size is not None:
+                    canvas_size = (canvas_size[0] // 2, canvas_size[1] // 2)
 
             # Add Loss layer 
             if layer_list[i] in content_layers and cfg.content_weight > 0:
@@ -191,7 +245,10 @@ def build_net(cfg, device, dtype, tight_mask, loss_mask, StyleLoss, ContentLoss,
 
             if layer_list[i] in style_layers and cfg.style_weight > 0:
                 print('Add Style Loss at Position {}'.format(str(len(net))))
-                style_loss_layer = StyleLoss(device=device, dtype=dtype, weight=cfg.style_weight, loss_mask=loss_mask, match_patch_size=cfg.match_patch_size, stride=1)
+                style_loss_layer = StyleLoss(device=device, dtype=dtype, weight=cfg.style_weight, loss_mask=loss_mask, match_patch_size=cfg.match_patch_size, stride=1,
+                                             match_mem_budget=cfg.match_mem_budget, match_region=cfg.match_region,
+                                             matcher=cfg.matcher, patchmatch_iter=cfg.patchmatch_iter,
+                                             coarse_to_fine=cfg.coarse_to_fine, match_window=cfg.match_window, gram_symmetric=cfg.gram_symmetric)
                 net.add_module(str(len(net)), style_loss_layer)
                 style_loss_list.append(style_loss_layer)
                 next_style_idx += 1
@@ -199,7 +256,8 @@ def build_net(cfg, device, dtype, tight_mask, loss_mask, StyleLoss, ContentLoss,
             # For pass1, cfg.histogram_weight == 0, no histogram layer is added here
             if layer_list[i] in histogram_layers and cfg.histogram_weight > 0:
                 print('Add Histogram Loss at Position {}'.format(str(len(net))))
-                histogram_loss_layer = HistogramLoss(device=device, dtype=dtype, weight=cfg.histogram_weight, loss_mask=loss_mask, tight_mask=tight_mask, n_bins=256) 
+                n_outside = 0 if canvas_size is None else canvas_size[0] * canvas_size[1] - tight_mask.shape[2] * tight_mask.shape[3]
+                histogram_loss_layer = HistogramLoss(device=device, dtype=dtype, weight=cfg.histogram_weight, loss_mask=loss_mask, tight_mask=tight_mask, n_bins=256, n_outside=n_outside) 
                 net.add_module(str(len(net)), histogram_loss_layer)
                 histogram_loss_list.append(histogram_loss_layer)
 
@@ -213,8 +271,12 @@ def build_net(cfg, device, dtype, tight_mask, loss_mask, StyleLoss, ContentLoss,
     
     return content_loss_list, style_loss_list, tv_loss_list, histogram_loss_list, net
 
-def capture_fm_pass1(content_loss_list, style_loss_list, tv_loss_list, content_img, style_img, net):
-    
+def capture_fm_pass1(content_loss_list, style_loss_list, tv_loss_list, content_img, style_img, net, style_fms=None):
+    '''
+    Input:
+        style_fms : list of style feature map for each style loss layer (tiled mode, style window larger than content_img), 
+                    if None, style feature map is captured from style_img 
+    '''
     print('\n===> Capture Feature Map & Compute Style Loss Match')
     start_time = time.time()
     
@@ -226,9 +288,22 @@ def capture_fm_pass1(content_loss_list, style_loss_list, tv_loss_list, content_i
 
     for i in content_loss_list:
         i.mode = 'None'
-    for i in style_loss_list:
-        i.mode = 'capture_style'
-    net(style_img)
+    if style_fms is None:
+        for i in style_loss_list:
+            i.mode = 'capture_style'
+        net(style_img)
+    else:
+        for i, style_fm in zip(style_loss_list, style_fms):
+            print('StyleLoss use style window feature map with shape {} '.format(str(style_fm.shape)))
+            i.style_fm = style_fm
+            if not i.coarse_to_fine:
+                i.compute_target()
+
+    # Coarse to fine match, full search only at the deepest layer, each shallower layer search around the deeper match
+    coarse_idx = None
+    for i in reversed(style_loss_list):
+        if i.coarse_to_fine:
+            coarse_idx = i.compute_target(coarse_idx)
     
     time_elapsed = time.time() - start_time
     print('@ Time Spend : {:.04f} m {:.04f} s'.format(time_elapsed // 60, time_elapsed % 60))
@@ -242,6 +317,230 @@ def capture_fm_pass1(content_loss_list, style_loss_list, tv_loss_list, content_i
     return None
 
 
+def pyramid_level_count(cfg, H, W):
+    '''
+    Return : 
+        number of pyramid level to use, cfg.pyramid_levels capped so that at the coarsest level the feature map of the 
+        deepest loss layer is still at least `match_patch_size` on both side 
+    Notice : 
+        raise ValueError when the level has to be capped but `pyramid_iter` give iteration for cfg.pyramid_levels level 
+    '''
+    layer_list = vgg16_dict if cfg.model == 'vgg16' else vgg19_dict
+    _, stride = receptive_field(layer_list, deepest_layer(layer_list, loss_layer_names(cfg)))
+
+    levels = 1
+    while levels < cfg.pyramid_levels and min(H, W) // 2 ** levels // stride >= cfg.match_patch_size:
+        levels += 1
+
+    if levels < cfg.pyramid_levels:
+        message = 'image of size {}x{} support at most {} pyramid level (feature map of the deepest loss layer must be at least {} at the coarsest level), got {}'.format(
+            H, W, levels, cfg.match_patch_size, cfg.pyramid_levels)
+        if cfg.pyramid_iter is not None:
+            raise ValueError(message)
+        print('Warning : ' + message + ', use {} level'.format(levels))
+    return levels
+
+
+def pyramid_iters(cfg, levels):
+    '''
+    Return : 
+        list of iteration for each level, coarse to fine 
+    Notice : 
+        by default a coarse level at 1/s resolution run cfg.n_iter / s (cheap iteration, only need to get close) and 
+        full resolution run cfg.n_iter // 5 to refine detail 
+    '''
+    if cfg.pyramid_iter is not None:
+        level_iters = [int(x) for x in cfg.pyramid_iter.split(',')]
+        assert (len(level_iters) == levels), 'pyramid_iter need one iteration number for each level'
+        return level_iters
+    return [max(1, cfg.n_iter // 2 ** (levels - 1 - level)) for level in range(levels - 1)] + [max(1, cfg.n_iter // 5)]
+
+
+def train_pyramid(cfg, device, dtype, optim_img, images, tight_mask, loss_mask, StyleLoss, capture_fn, backbone=None):
+    '''
+    Functionality : 
+        optimize from 1 / 2^(levels-1) resolution up to full resolution, result of each level is upsampled as the 
+        next level's optim image (only inside loss mask). Network, match and target are rebuilt at every level 
+    Input : 
+        optim_img : full resolution image to be optimized, same as train 
+        images : list of full resolution image passed to capture_fn (target is always captured from the original image) 
+        capture_fn : capture_fn(content_loss_list, style_loss_list, tv_loss_list, histogram_loss_list, images, net)
+        backbone : same as build_net 
+    Return : 
+        same as train, loss history of all level are concatenated 
+    '''
+    H, W = optim_img.shape[2], optim_img.shape[3]
+    level_iters = pyramid_iters(cfg, pyramid_level_count(cfg, H, W))
+    content_loss_his, style_loss_his, tv_loss_his, histogram_loss_his = [], [], [], []
+    img = None
+
+    for level, n_iter in enumerate(level_iters):
+        scale = 2 ** (len(level_iters) - 1 - level)
+        print('\n===> Pyramid Level {} / {} Scale 1/{} Iteration {}'.format(level + 1, len(level_iters), scale, n_iter))
+
+        if scale == 1:
+            level_optim_img, level_images, level_tight_mask, level_loss_mask = optim_img, images, tight_mask, loss_mask
+        else:
+            size = (max(1, H // scale), max(1, W // scale))
+            level_optim_img = F.interpolate(optim_img, size=size, mode='area')
+            level_images = [F.interpolate(x, size=size, mode='area') for x in images]
+            level_tight_mask = (F.interpolate(tight_mask, size=size, mode='area') != 0).type(dtype)
+            level_loss_mask = (F.interpolate(loss_mask, size=size, mode='area') != 0).type(dtype)
+
+        # Start from the upsampled previous level inside mask, keep original image outside 
+        if img is not None:
+            img = F.interpolate(img.detach(), size=level_optim_img.shape[2:], mode='bilinear', align_corners=False)
+            level_optim_img = img * level_loss_mask + level_optim_img * (1 - level_loss_mask)
+
+        # Coarse level save with their own name, only the last level write cfg.output_img 
+        level_cfg = copy.copy(cfg)
+        level_cfg.n_iter = n_iter
+        if scale != 1:
+            output_filename, file_extension = os.path.splitext(cfg.output_img)
+            level_cfg.output_img = str(output_filename) + '_level{}'.format(level + 1) + str(file_extension)
+
+        content_loss_list, style_loss_list, tv_loss_list, histogram_loss_list, net = build_net(level_cfg, device, dtype, level_tight_mask, level_loss_mask, StyleLoss, ContentLoss, TVLoss, HistogramLoss, backbone=backbone)
+        capture_fn(content_loss_list, style_loss_list, tv_loss_list, histogram_loss_list, level_images, net)
+        img, c_his, s_his, tv_his, h_his = train(level_cfg, device, dtype, net, level_tight_mask, level_loss_mask, level_optim_img, content_loss_list, style_loss_list, tv_loss_list, histogram_loss_list)
+
+        content_loss_his += c_his
+        style_loss_his += s_his
+        tv_loss_his += tv_his
+        histogram_loss_his += h_his
+        del net
+
+    return img, content_loss_his, style_loss_his, tv_loss_his, histogram_loss_his
+
+
+def train_batch(cfg, device, dtype, StyleLoss, capture_fn, image_fn):
+    '''
+    Functionality : 
+        build net & capture target for each job in cfg.batch_file, then optimize all job as one N * 3 * H * W image 
+    Input : 
+        capture_fn : same as train_pyramid 
+        image_fn : image_fn(content_img, style_img, inter_img) return list of image passed to capture_fn, first one is optimized 
+    Return : 
+        img, loss history (sum of all job), list of job cfg, list of (style_img, tight_mask) of each job 
+    '''
+    job_cfgs = load_batch_cfgs(cfg)
+    backbone = build_backbone(cfg)
+
+    nets, samples, optim_imgs, tight_masks, loss_masks, crop_images = [], [], [], [], [], []
+    for n, job_cfg in enumerate(job_cfgs):
+        print('\n===> Job {} / {}'.format(n + 1, len(job_cfgs)))
+        content_img, style_img, inter_img, tight_mask, loss_mask = preprocess(job_cfg, dtype, device)
+        images = image_fn(content_img, style_img, inter_img)
+        assert (n == 0 or images[0].shape == optim_imgs[0].shape), 'batch job must have the same image size'
+
+        content_loss_list, style_loss_list, tv_loss_list, histogram_loss_list, net = build_net(job_cfg, device, dtype, tight_mask, loss_mask, StyleLoss, ContentLoss, TVLoss, HistogramLoss, backbone=backbone)
+        capture_fn(content_loss_list, style_loss_list, tv_loss_list, histogram_loss_list, images, net)
+
+        nets.append(net)
+        samples.append((job_cfg, content_loss_list, style_loss_list, tv_loss_list, histogram_loss_list))
+        optim_imgs.append(images[0])
+        tight_masks.append(tight_mask)
+        loss_masks.append(loss_mask)
+        crop_images.append((style_img, tight_mask))
+
+    # One forward / backward for all job 
+    net = batch_net(nets)
+    del nets
+    loss_lists = [sum([list(sample[k]) for sample in samples], []) for k in range(1, 5)]
+    img, content_loss_his, style_loss_his, tv_loss_his, histogram_loss_his = train(cfg, device, dtype, net, torch.cat(tight_masks), torch.cat(loss_masks), torch.cat(optim_imgs), *loss_lists, samples=samples)
+
+    return img, content_loss_his, style_loss_his, tv_loss_his, histogram_loss_his, job_cfgs, crop_images
+
+
+def train_tiled(cfg, device, dtype, optim_img, images, tight_mask, loss_mask, StyleLoss, capture_fn, backbone=None, style_img=None):
+    '''
+    Functionality : 
+        split the canvas into overlapping tiles around the mask (see `tile_boxes`), build net, capture & train each tile, 
+        result of the tiles are blended with feathered weight (see `feather_weight`), so activation memory is bounded by tile size 
+    Input : 
+        optim_img, images, capture_fn : same as train_pyramid, images are cropped to each tile 
+        style_img : if given, style feature map of each tile is computed over the style window (tile grown by 
+                    `cfg.tile_style_context`, whole style image by default) with `tiled_features` & passed to capture_fn 
+                    as `style_fms`, so style patch search is not limited to the tile 
+    Return : 
+        same as train, loss history of all tile are concatenated 
+    '''
+    if backbone is None:
+        backbone = build_backbone(cfg)
+    cnn, layer_list = backbone
+
+    # Tile aligned to the total stride of the deepest layer so pooling grid of tile match the whole canvas 
+    rf, align = receptive_field(layer_list, deepest_layer(layer_list, loss_layer_names(cfg)))
+    boxes = tile_boxes(loss_mask, cfg.tile_size, cfg.tile_overlap, align)
+    H, W = optim_img.shape[2], optim_img.shape[3]
+
+    # Weighted sum of tile result, tile start from the blended result of previous tile 
+    blend_sum = torch.zeros_like(optim_img)
+    blend_weight = torch.zeros_like(loss_mask)
+    content_loss_his, style_loss_his, tv_loss_his, histogram_loss_his = [], [], [], []
+
+    for k, bbox in enumerate(boxes):
+        print('\n===> Tile {} / {} {}'.format(k + 1, len(boxes), str(bbox)))
+        canvas = torch.where(blend_weight > 0, blend_sum / blend_weight.clamp(min=1e-9), optim_img)
+        tile_images = [roi_crop(x, bbox) for x in images]
+        tile_tight_mask, tile_loss_mask = roi_crop(tight_mask, bbox), roi_crop(loss_mask, bbox)
+
+        tile_cfg = copy.copy(cfg)
+        output_filename, file_extension = os.path.splitext(cfg.output_img)
+        tile_cfg.output_img = str(output_filename) + '_tile{}'.format(k + 1) + str(file_extension)
+
+        content_loss_list, style_loss_list, tv_loss_list, histogram_loss_list, net = build_net(tile_cfg, device, dtype, tile_tight_mask, tile_loss_mask, StyleLoss, ContentLoss, TVLoss, HistogramLoss, backbone=backbone)
+        if style_img is None:
+            capture_fn(content_loss_list, style_loss_list, tv_loss_list, histogram_loss_list, tile_images, net)
+        else:
+            y0, y1, x0, x1 = bbox
+            context = cfg.tile_style_context
+            window = (0, H, 0, W)
+            if context >= 0:
+                window = (max(0, y0 - context) // align * align, min(H, y1 + context), max(0, x0 - context) // align * align, min(W, x1 + context))
+            style_layers = known_layers(layer_list, cfg.style_layers.split(',')) if cfg.style_weight > 0 else []
+            margin = -(-rf // align) * align  # receptive field round up to total stride 
+            style_fms = tiled_features(cnn, layer_list, style_layers, roi_crop(style_img, window), max(align, cfg.tile_size // align * align), margin) if style_layers else []
+            capture_fn(content_loss_list, style_loss_list, tv_loss_list, histogram_loss_list, tile_images, net, style_fms=style_fms)
+
+        img, c_his, s_his, tv_his, h_his = train(tile_cfg, device, dtype, net, tile_tight_mask, tile_loss_mask, roi_crop(canvas, bbox), content_loss_list, style_loss_list, tv_loss_list, histogram_loss_list)
+        del net
+
+        y0, y1, x0, x1 = bbox
+        weight = feather_weight(bbox, (H, W), cfg.tile_overlap).type(dtype).to(device)
+        blend_sum[:, :, y0:y1, x0:x1] += img.detach() * weight
+        blend_weight[:, :, y0:y1, x0:x1] += weight
+
+        content_loss_his += c_his
+        style_loss_his += s_his
+        tv_loss_his += tv_his
+        histogram_loss_his += h_his
+
+    img = torch.where(blend_weight > 0, blend_sum / blend_weight.clamp(min=1e-9), optim_img)
+    img_deprocess(img.clone()).save(str(cfg.output_img))
+
+    return img, content_loss_his, style_loss_his, tv_loss_his, histogram_loss_his
+
+
+def build_roi(cfg, loss_mask):
+    '''
+    Functionality : 
+        region of interest for roi mode, the bounding box of dilated mask grown by the receptive field of the 
+        deepest loss layer, so that feature map inside the (layer) loss mask see the same input as on the whole canvas 
+    Return : 
+        (y0, y1, x0, x1) 
+    Notice : 
+        style feature map is also cropped, so style patch can only be matched from inside the roi 
+    '''
+    layer_list = vgg16_dict if cfg.model == 'vgg16' else vgg19_dict
+    rf, stride = receptive_field(layer_list, deepest_layer(layer_list, loss_layer_names(cfg)))
+
+    margin = rf if cfg.roi_margin is None else cfg.roi_margin
+    bbox = mask_bbox(loss_mask, margin=margin, align=stride) # align to total stride so pooling grid match the whole canvas 
+
+    print('\n===> ROI {} (margin {}) of image {}'.format(str(bbox), margin, str(tuple(loss_mask.shape[2:]))))
+    return bbox
+
+
 def main():
     # Initial Config 
     cfg = get_args()
@@ -251,16 +550,51 @@ def main():
 
     # Initial Config 
     dtype, device = setup(cfg)
-    content_img, style_img, inter_img, tight_mask, loss_mask = preprocess(cfg, dtype, device) # For pass1, inter_img is the official result and is not used in this case 
 
-    # Build Network 
-    content_loss_list, style_loss_list, tv_loss_list, histogram_loss_list, net = build_net(cfg, device, dtype, tight_mask, loss_mask, StyleLossPass1, ContentLoss, TVLoss, HistogramLoss)
+    # Batch mode, all job in cfg.batch_file are optimized together 
+    if cfg.batch_file is not None:
+        capture_fn = lambda c_list, s_list, tv_list, h_list, images, net: capture_fm_pass1(c_list, s_list, tv_list, *images, net)
+        image_fn = lambda content_img, style_img, inter_img: [content_img, style_img]
+        inter_img, content_loss_his, style_loss_his, tv_loss_his, histogram_loss_his, job_cfgs, crop_images = train_batch(cfg, device, dtype, StyleLossPass1, capture_fn, image_fn)
+        plt_plot_loss(content_loss_his, style_loss_his, tv_loss_his, histogram_loss_his, name='pass1')
+        for n, (job_cfg, (style_img, tight_mask)) in enumerate(zip(job_cfgs, crop_images)):
+            tight_mask_crop(job_cfg, inter_img[n:n + 1], style_img, tight_mask)
+        end_log(orig_stdout)
+        return
 
-    # Capture FM & Compute Match 
-    capture_fm_pass1(content_loss_list, style_loss_list, tv_loss_list, content_img, style_img, net)
+    content_img, style_img, inter_img, tight_mask, loss_mask = preprocess(cfg, dtype, device) # For pass1, inter_img is the official result and is not used in this case 
 
-    # Training 
-    inter_img, content_loss_his, style_loss_his, tv_loss_his, histogram_loss_his = train(cfg, device, dtype, net, tight_mask, loss_mask, content_img, content_loss_list, style_loss_list, tv_loss_list, histogram_loss_list)
+    # Crop everything to the region of interest 
+    if cfg.roi:
+        bbox = build_roi(cfg, loss_mask)
+        full_content_img, full_style_img, full_tight_mask = content_img, style_img, tight_mask
+        content_img, style_img, tight_mask, loss_mask = [roi_crop(x, bbox) for x in (content_img, style_img, tight_mask, loss_mask)]
+
+    if cfg.tile_size > 0:
+        # Build Network, Capture FM & Training tile by tile, style is matched over the style window 
+        capture_fn = lambda c_list, s_list, tv_list, h_list, images, net, style_fms=None: capture_fm_pass1(c_list, s_list, tv_list, *images, net, style_fms=style_fms)
+        inter_img, content_loss_his, style_loss_his, tv_loss_his, histogram_loss_his = train_tiled(cfg, device, dtype, content_img, [content_img, style_img], tight_mask, loss_mask, StyleLossPass1, capture_fn, style_img=style_img)
+    elif cfg.pyramid_levels > 1:
+        # Build Network, Capture FM & Training level by level 
+        capture_fn = lambda c_list, s_list, tv_list, h_list, images, net: capture_fm_pass1(c_list, s_list, tv_list, *images, net)
+        inter_img, content_loss_his, style_loss_his, tv_loss_his, histogram_loss_his = train_pyramid(cfg, device, dtype, content_img, [content_img, style_img], tight_mask, loss_mask, StyleLossPass1, capture_fn)
+    else:
+        # Build Network 
+        content_loss_list, style_loss_list, tv_loss_list, histogram_loss_list, net = build_net(cfg, device, dtype, tight_mask, loss_mask, StyleLossPass1, ContentLoss, TVLoss, HistogramLoss)
+
+        # Capture FM & Compute Match, skipped when resume from checkpoint 
+        resume_state = load_checkpoint(cfg, device) if cfg.resume else None
+        if resume_state is None:
+            capture_fm_pass1(content_loss_list, style_loss_list, tv_loss_list, content_img, style_img, net)
+
+        # Training 
+        inter_img, content_loss_his, style_loss_his, tv_loss_his, histogram_loss_his = train(cfg, device, dtype, net, tight_mask, loss_mask, content_img, content_loss_list, style_loss_list, tv_loss_list, histogram_loss_list, resume_state=resume_state)
+
+    # Put the optimized roi back to the whole canvas & overwrite the (roi sized) final image 
+    if cfg.roi:
+        inter_img = roi_paste(full_content_img, inter_img, bbox)
+        style_img, tight_mask = full_style_img, full_tight_mask
+        img_deprocess(inter_img.clone()).save(str(cfg.output_img))
     
     # Plot History 
     plt_plot_loss(content_loss_his, style_loss_his, tv_loss_his, histogram_loss_his, name='pass1')
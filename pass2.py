@@ -6,7 +6,7 @@ import torch
 import torchvision
 from model import *
 from utils import *
-from pass1 import train, build_net
+from pass1 import train, build_net, build_roi, train_pyramid, train_batch, train_tiled
 
 if not os.path.exists('output'):
     os.makedirs('output')
@@ -87,16 +87,52 @@ def main():
 
     # Initial Config 
     dtype, device = setup(cfg)
-    content_img, style_img, inter_img, tight_mask, loss_mask = preprocess(cfg, dtype, device) # For Pass1, inter_img is the output of pass1
 
-    # Build Network 
-    content_loss_list, style_loss_list, tv_loss_list, histogram_loss_list, net = build_net(cfg, device, dtype, tight_mask, loss_mask, StyleLossPass2, ContentLoss, TVLoss, HistogramLoss)
+    # Batch mode, all job in cfg.batch_file are optimized together 
+    if cfg.batch_file is not None:
+        capture_fn = lambda c_list, s_list, tv_list, h_list, images, net: capture_fm_pass2(c_list, s_list, tv_list, h_list, *images, net)
+        image_fn = lambda content_img, style_img, inter_img: [inter_img, content_img, style_img]
+        final_img, content_loss_his, style_loss_his, tv_loss_his, histogram_loss_his, job_cfgs, crop_images = train_batch(cfg, device, dtype, StyleLossPass2, capture_fn, image_fn)
+        plt_plot_loss(content_loss_his, style_loss_his, tv_loss_his, histogram_loss_his, name='pass2')
+        for n, (job_cfg, (style_img, tight_mask)) in enumerate(zip(job_cfgs, crop_images)):
+            tight_mask_crop(job_cfg, final_img[n:n + 1], style_img, tight_mask)
+        end_log(orig_stdout)
+        return
 
-    # Capture FM & Compute Match 
-    capture_fm_pass2(content_loss_list, style_loss_list, tv_loss_list, histogram_loss_list, inter_img, content_img, style_img, net)
+    content_img, style_img, inter_img, tight_mask, loss_mask = preprocess(cfg, dtype, device) # For Pass1, inter_img is the output of pass1
 
-    # Training 
-    final_img, content_loss_his, style_loss_his, tv_loss_his, histogram_loss_his = train(cfg, device, dtype, net, tight_mask, loss_mask, inter_img, content_loss_list, style_loss_list, tv_loss_list, histogram_loss_list)
+    # Crop everything to the region of interest 
+    if cfg.roi:
+        bbox = build_roi(cfg, loss_mask)
+        full_inter_img, full_style_img, full_tight_mask = inter_img, style_img, tight_mask
+        content_img, style_img, inter_img, tight_mask, loss_mask = [roi_crop(x, bbox) for x in (content_img, style_img, inter_img, tight_mask, loss_mask)]
+
+    if cfg.tile_size > 0:
+        # Build Network, Capture FM & Training tile by tile. Spatial consistency need style aligned with the tile, so style is cropped to the tile 
+        capture_fn = lambda c_list, s_list, tv_list, h_list, images, net: capture_fm_pass2(c_list, s_list, tv_list, h_list, *images, net)
+        final_img, content_loss_his, style_loss_his, tv_loss_his, histogram_loss_his = train_tiled(cfg, device, dtype, inter_img, [inter_img, content_img, style_img], tight_mask, loss_mask, StyleLossPass2, capture_fn)
+    elif cfg.pyramid_levels > 1:
+        # Build Network, Capture FM & Training level by level 
+        capture_fn = lambda c_list, s_list, tv_list, h_list, images, net: capture_fm_pass2(c_list, s_list, tv_list, h_list, *images, net)
+        final_img, content_loss_his, style_loss_his, tv_loss_his, histogram_loss_his = train_pyramid(cfg, device, dtype, inter_img, [inter_img, content_img, style_img], tight_mask, loss_mask, StyleLossPass2, capture_fn)
+    else:
+        # Build Network 
+        canvas_size = tuple(full_inter_img.shape[2:]) if cfg.roi else None
+        content_loss_list, style_loss_list, tv_loss_list, histogram_loss_list, net = build_net(cfg, device, dtype, tight_mask, loss_mask, StyleLossPass2, ContentLoss, TVLoss, HistogramLoss, canvas_size=canvas_size)
+
+        # Capture FM & Compute Match, skipped when resume from checkpoint 
+        resume_state = load_checkpoint(cfg, device) if cfg.resume else None
+        if resume_state is None:
+            capture_fm_pass2(content_loss_list, style_loss_list, tv_loss_list, histogram_loss_list, inter_img, content_img, style_img, net)
+
+        # Training 
+        final_img, content_loss_his, style_loss_his, tv_loss_his, histogram_loss_his = train(cfg, device, dtype, net, tight_mask, loss_mask, inter_img, content_loss_list, style_loss_list, tv_loss_list, histogram_loss_list, resume_state=resume_state)
+
+    # Put the optimized roi back to the whole canvas & overwrite the (roi sized) final image 
+    if cfg.roi:
+        final_img = roi_paste(full_inter_img, final_img, bbox)
+        style_img, tight_mask = full_style_img, full_tight_mask
+        img_deprocess(final_img.clone()).save(str(cfg.output_img))
     
     # Plot History 
     plt_plot_loss(content_loss_his, style_loss_his, tv_loss_his, histogram_loss_his, name='pass2')
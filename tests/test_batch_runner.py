@@ -0,0 +1,50 @@
+# EECS 442 @ UMich Final Project 
+# No commercial Use Allowed 
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from batch_runner import build_batch_parser, run_job
+
+
+def write_stage(tmp_path):
+    '''
+    Return :
+        cfg & one stage that copy input.txt to output.txt, output already exist & is newer than input
+    '''
+    cfg = build_batch_parser().parse_args(['-output_dir', str(tmp_path)])
+    src, dst = str(tmp_path / 'input.txt'), str(tmp_path / 'output.txt')
+    with open(src, 'w') as f:
+        f.write('new')
+    with open(dst, 'w') as f:
+        f.write('old')
+    os.utime(src, (1, 1))
+    stage = {'name': 'pass1', 'cmd': ['-c', 'import shutil; shutil.copy({!r}, {!r})'.format(src, dst)], 'inputs': [src], 'output': dst}
+    return cfg, stage, dst
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+def test_skip_only_finished_stage(tmp_path):
+    cfg, stage, dst = write_stage(tmp_path)
+    job = {'name': '1'}
+
+    # Output newer than input but not finished in an earlier run (no record, stopped or timed out) 
+    for previous in [None, {'stages': {'pass1': {'status': 'timeout'}}}, {'stages': {'pass1': {'status': 'failed'}}}]:
+        with open(dst, 'w') as f:
+            f.write('old')
+        record = run_job(job, [stage], cfg, previous)
+        assert record['stages']['pass1']['status'] == 'done'
+        assert read(dst) == 'new'
+
+    # Finished & up to date 
+    with open(dst, 'w') as f:
+        f.write('old')
+    record = run_job(job, [stage], cfg, {'stages': {'pass1': {'status': 'done'}}})
+    assert record['status'] == 'skipped'
+    assert read(dst) == 'old'
@@ -0,0 +1,90 @@
+# EECS 442 @ UMich Final Project 
+# No commercial Use Allowed 
+
+import os
+import sys
+import torch
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model import *
+from utils import *
+from harmonize import get_harmonize_args, run_pass, harmonize
+from pass1 import capture_fm_pass1
+
+
+def small_setup(tmp_path):
+    '''
+    Return :
+        cfg1, cfg2, dtype, device & backbone with random weight, so no model file is needed
+    '''
+    torch.manual_seed(0)
+    cfg1, cfg2 = get_harmonize_args(['-gpu', 'cpu', '-output_img_size', '64', '-n_iter', '3', '-p2_n_iter', '3',
+                                     '-content_layers', 'relu2_1', '-style_layers', 'relu1_1,relu2_1',
+                                     '-p2_content_layers', 'relu2_1', '-p2_style_layers', 'relu1_1,relu2_1',
+                                     '-output_img', str(tmp_path / 'final.png')])
+    dtype, device = setup(cfg1)
+    layer_list = vgg19_dict[:vgg19_dict.index('relu2_1') + 1]
+    cnn = build_trunk(layer_list, len(layer_list)).eval()
+    for param in cnn.parameters():
+        param.requires_grad = False
+    return cfg1, cfg2, dtype, device, (cnn, layer_list)
+
+
+def test_pass1_keep_content_img(tmp_path):
+    cfg1, _, dtype, device, backbone = small_setup(tmp_path)
+    content_img, style_img, _, tight_mask, loss_mask = preprocess(cfg1, dtype, device)
+    content_copy = content_img.clone()
+
+    capture_fn = lambda c_list, s_list, tv_list, h_list, images, net: capture_fm_pass1(c_list, s_list, tv_list, *images, net)
+    inter_img = run_pass(cfg1, device, dtype, backbone, content_img, [content_img, style_img], tight_mask, loss_mask, StyleLossPass1, capture_fn)[0]
+
+    # Pass2 use content_img as target, it must still be the input image 
+    assert torch.equal(content_img, content_copy)
+    assert not torch.equal(inter_img, content_img)
+
+
+def test_harmonize_save_both_pass(tmp_path):
+    cfg1, cfg2, dtype, device, backbone = small_setup(tmp_path)
+    params = [param.clone() for param in backbone[0].parameters()]
+
+    result = harmonize(cfg1, cfg2, dtype, device, backbone, plot=False)
+    inter_img = img_preprocess(result['inter_img'], 64, norm=False)
+    output_img = img_preprocess(result['output_img'], 64, norm=False)
+
+    # Intermediate image is the pass1 result, not overwritten by pass2 
+    assert not torch.equal(inter_img, output_img)
+    # Shared backbone is not changed by a job 
+    assert all(torch.equal(param, saved) for param, saved in zip(backbone[0].parameters(), params))
+
+
+def test_harmonize_repeat_job(tmp_path):
+    # Same job run twice in one process (as in worker.py) give the same output 
+    cfg1, cfg2, dtype, device, backbone = small_setup(tmp_path)
+    for cfg in (cfg1, cfg2):
+        cfg.matcher = 'patchmatch'
+
+    outputs = []
+    for _ in range(2):
+        result = harmonize(copy.copy(cfg1), copy.copy(cfg2), dtype, device, backbone, plot=False)
+        outputs.append(img_preprocess(result['output_img'], 64, norm=False))
+        torch.rand(100)
+    assert torch.equal(outputs[0], outputs[1])
+
+
+def test_harmonize_tiled(tmp_path):
+    cfg1, cfg2, dtype, device, backbone = small_setup(tmp_path)
+    for cfg in (cfg1, cfg2):
+        cfg.tile_size, cfg.tile_overlap = 32, 8
+
+    harmonize(cfg1, cfg2, dtype, device, backbone, plot=False)
+    # Both pass are optimized tile by tile 
+    for cfg in (cfg1, cfg2):
+        output_filename, file_extension = os.path.splitext(cfg.output_img)
+        assert os.path.exists(output_filename + '_tile1' + file_extension)
+
+
+def test_harmonize_reject_batch_file(tmp_path):
+    with pytest.raises(AssertionError):
+        get_harmonize_args(['-batch_file', str(tmp_path / 'jobs.json')])
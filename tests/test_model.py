@@ -0,0 +1,151 @@
+# EECS 442 @ UMich Final Project 
+# No commercial Use Allowed 
+
+import os
+import sys
+import torch
+import numpy as np
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model import *
+
+
+def test_masked_gram_mse_match_hook_graph():
+    # Fused function against gram * mask -> mse graph with a gradient mask hook, gradient of the next layer included 
+    torch.manual_seed(0)
+    mask = torch.rand(1, 1, 6, 7, dtype=torch.float64) * (torch.rand(1, 1, 6, 7) > 0.4)
+    target = torch.rand(1, 5, 9, dtype=torch.float64)
+    target = torch.bmm(target, target.transpose(1, 2))  # gram matrix, symmetric 
+    input = torch.rand(1, 5, 6, 7, dtype=torch.float64)
+    grad_next = torch.rand(1, 5, 6, 7, dtype=torch.float64)
+
+    x = input.clone().requires_grad_(True)
+    fm = (x * mask).reshape(1, 5, -1)
+    loss = F.mse_loss(torch.bmm(fm, fm.transpose(1, 2)), target) * 3
+    x.register_hook(lambda grad: grad * mask)
+    (loss + (x * grad_next).sum()).backward()
+
+    y = input.clone().requires_grad_(True)
+    output, fused_loss = MaskedGramMSELoss.apply(y, MaskedGramMatrix(mask), target, 3, mask.expand_as(y))
+    (fused_loss + (output * grad_next).sum()).backward()
+
+    assert torch.allclose(loss, fused_loss)
+    assert torch.allclose(x.grad, y.grad)
+
+
+
+def test_histogram_loss_roi_match_full_canvas():
+    # Same feature map on the whole canvas & cropped to a roi around the mask 
+    torch.manual_seed(0)
+    C, H, W, bbox = 4, 20, 24, (3, 15, 5, 19)
+    tight_mask = torch.zeros(1, 1, H, W, dtype=torch.float64)
+    tight_mask[:, :, 6:12, 8:16] = 1
+    style_fm = torch.rand(1, C, H, W, dtype=torch.float64) + 0.1
+    input = torch.rand(1, C, H, W, dtype=torch.float64) + 0.1
+    crop = lambda x: x[:, :, bbox[0]:bbox[1], bbox[2]:bbox[3]]
+
+    losses, grads = [], []
+    for n_outside, fm_crop in [(0, lambda x: x), (H * W - (bbox[1] - bbox[0]) * (bbox[3] - bbox[2]), crop)]:
+        histogram_loss = HistogramLoss('cpu', torch.float64, 1, fm_crop(tight_mask), fm_crop(tight_mask), n_bins=16, n_outside=n_outside)
+        histogram_loss.style_fm_matched = fm_crop(style_fm)
+        histogram_loss.compute_histogram()
+        histogram_loss.mode = 'loss'
+
+        x = fm_crop(input).clone().requires_grad_(True)
+        histogram_loss(x)
+        histogram_loss.loss.backward()
+        losses.append(histogram_loss.loss)
+        grads.append(x.grad)
+
+    assert torch.allclose(losses[0], losses[1])
+    assert torch.allclose(crop(grads[0]), grads[1])
+
+
+def match_fm_ref_loop(style_fm, corr_tmp, patch_size):
+    # Spatial consistency step as the original per-location loop 
+    ref_h, ref_w = style_fm.shape[2], style_fm.shape[3]
+    padding = (patch_size - 1) // 2
+    padding_style_fm = F.pad(style_fm, [padding, padding, padding, padding], mode='reflect')
+    ref_corr = np.zeros((ref_h, ref_w))
+    inside = lambda h, w: 0 <= h < ref_h and 0 <= w < ref_w
+
+    for i in range(ref_h):
+        for j in range(ref_w):
+            neighbors = [(int(corr_tmp[0, i + di, j + dj]), int(corr_tmp[1, i + di, j + dj]), di, dj)
+                         for di in [-1, 0, 1] for dj in [-1, 0, 1] if inside(i + di, j + dj)]
+            candidate_set = set((p_h - di, p_w - dj) for p_h, p_w, di, dj in neighbors if inside(p_h - di, p_w - dj))
+
+            min_sum = np.inf
+            for c_h, c_w in candidate_set:
+                style_fm_ref_c = get_patch(padding_style_fm, c_h, c_w, patch_size)
+                sum = 0
+                for p_h, p_w, _, _ in neighbors:
+                    if inside(p_h, p_w):
+                        sum += F.conv2d(style_fm_ref_c, get_patch(padding_style_fm, p_h, p_w, patch_size)).item()
+                if sum < min_sum:
+                    min_sum = sum
+                    ref_corr[i, j] = c_h * ref_w + c_w
+
+    style_fm_matched = style_fm.clone()
+    for i in range(ref_h):
+        for j in range(ref_w):
+            style_fm_matched[:, :, i, j] = style_fm[:, :, int(ref_corr[i, j]) // ref_w, int(ref_corr[i, j]) % ref_w]
+    return ref_corr.astype(np.int64), style_fm_matched
+
+
+def test_match_fm_ref_match_loop():
+    torch.manual_seed(0)
+    style_fm = torch.rand(1, 6, 9, 11, dtype=torch.float64)
+    img_fm = torch.rand(1, 6, 9, 11, dtype=torch.float64)
+    # Small budget so the candidate scoring run in several chunk 
+    style_loss = StyleLossPass2('cpu', torch.float64, 1, torch.ones(1, 1, 9, 11, dtype=torch.float64), 3, 1, match_mem_budget=0.01)
+
+    ref_corr, style_fm_matched = style_loss.match_fm_ref(style_fm, img_fm)
+    _, corr_tmp = style_loss.match_fm(img_fm, style_fm)
+    ref_corr_loop, style_fm_matched_loop = match_fm_ref_loop(style_fm, corr_tmp, 3)
+
+    assert torch.equal(ref_corr, torch.from_numpy(ref_corr_loop))
+    assert torch.equal(style_fm_matched, style_fm_matched_loop)
+
+
+def upsample_corr_loop(ref_corr, curr_h, curr_w, style_fm):
+    # Original per-pixel loop 
+    curr_corr = np.zeros((curr_h, curr_w))
+    ref_h, ref_w = ref_corr.shape
+    h_ratio = curr_h / ref_h
+    w_ratio = curr_w / ref_w
+    style_fm_matched = style_fm.clone()
+
+    for i in range(curr_h):
+        for j in range(curr_w):
+            ref_idx = [(i + 0.4999) // h_ratio, (j + 0.4999) // w_ratio]
+            ref_idx[0] = int(max(min(ref_idx[0], ref_h - 1), 0))
+            ref_idx[1] = int(max(min(ref_idx[1], ref_w - 1), 0))
+
+            ref_mapping_idx = ref_corr[ref_idx[0], ref_idx[1]]
+            ref_mapping_idx = (ref_mapping_idx // ref_w, ref_mapping_idx % ref_w)
+
+            curr_mapping_idx = (int(i + (ref_mapping_idx[0] - ref_idx[0]) * h_ratio + 0.4999),
+                                int(j + (ref_mapping_idx[1] - ref_idx[1]) * w_ratio + 0.4999))
+            assert 0 <= curr_mapping_idx[0] < curr_h and 0 <= curr_mapping_idx[1] < curr_w
+            curr_corr[i, j] = curr_mapping_idx[0] * curr_w + curr_mapping_idx[1]
+            style_fm_matched[:, :, i, j] = style_fm[:, :, curr_mapping_idx[0], curr_mapping_idx[1]]
+
+    return curr_corr, style_fm_matched
+
+
+def test_upsample_corr_match_loop():
+    torch.manual_seed(0)
+    ref_corr = torch.randint(0, 5 * 6, (5, 6))
+    style_loss = StyleLossPass2('cpu', torch.float64, 1, torch.ones(1, 1, 5, 6, dtype=torch.float64), 3, 1)
+
+    # Even & odd size of the shallower layer (pooling round down) 
+    for curr_h, curr_w in [(10, 12), (11, 13), (5, 6)]:
+        style_fm = torch.rand(1, 4, curr_h, curr_w, dtype=torch.float64)
+        curr_corr, style_fm_matched = style_loss.upsample_corr(ref_corr, curr_h, curr_w, style_fm)
+        curr_corr_loop, style_fm_matched_loop = upsample_corr_loop(ref_corr.numpy(), curr_h, curr_w, style_fm)
+
+        assert torch.equal(curr_corr.long(), torch.from_numpy(curr_corr_loop).long())
+        assert torch.equal(style_fm_matched, style_fm_matched_loop)
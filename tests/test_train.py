@@ -0,0 +1,95 @@
+# EECS 442 @ UMich Final Project 
+# No commercial Use Allowed 
+
+import os
+import torch
+import pytest
+
+from test_harmonize import small_setup
+from model import *
+from utils import *
+from pass1 import train, build_net, capture_fm_pass1
+
+
+def test_lbfgs_no_repeated_evaluation(tmp_path):
+    cfg1, _, dtype, device, backbone = small_setup(tmp_path)
+    cfg1.optim, cfg1.lr, cfg1.n_iter = 'lbfgs', 1e1, 20
+    content_img, style_img, _, tight_mask, loss_mask = preprocess(cfg1, dtype, device)
+
+    content_loss_list, style_loss_list, tv_loss_list, histogram_loss_list, net = build_net(cfg1, device, dtype, tight_mask, loss_mask, StyleLossPass1, ContentLoss, TVLoss, HistogramLoss, backbone=backbone)
+    capture_fm_pass1(content_loss_list, style_loss_list, tv_loss_list, content_img, style_img, net)
+
+    # Every image the closure is evaluated on 
+    evaluated = []
+    net.register_forward_pre_hook(lambda module, input: evaluated.append(input[0].detach().clone()))
+    train(cfg1, device, dtype, net, tight_mask, loss_mask, content_img, content_loss_list, style_loss_list, tv_loss_list, histogram_loss_list)
+
+    # n_iter + 1 evaluation (the line search can take one more), no image is evaluated twice 
+    assert cfg1.n_iter + 1 <= len(evaluated) <= cfg1.n_iter + 2
+    assert not any(torch.equal(evaluated[j], evaluated[k]) for k in range(len(evaluated)) for j in range(k))
+
+
+def test_interrupt_not_saved_as_output(tmp_path):
+    cfg1, _, dtype, device, backbone = small_setup(tmp_path)
+    content_img, style_img, _, tight_mask, loss_mask = preprocess(cfg1, dtype, device)
+
+    content_loss_list, style_loss_list, tv_loss_list, histogram_loss_list, net = build_net(cfg1, device, dtype, tight_mask, loss_mask, StyleLossPass1, ContentLoss, TVLoss, HistogramLoss, backbone=backbone)
+    capture_fm_pass1(content_loss_list, style_loss_list, tv_loss_list, content_img, style_img, net)
+
+    # Ctrl-C at the third iteration 
+    n_call = []
+    def interrupt(module, input):
+        n_call.append(1)
+        if len(n_call) == 3:
+            raise KeyboardInterrupt
+    net.register_forward_pre_hook(interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        train(cfg1, device, dtype, net, tight_mask, loss_mask, content_img, content_loss_list, style_loss_list, tv_loss_list, histogram_loss_list)
+
+    output_filename, file_extension = os.path.splitext(cfg1.output_img)
+    assert not os.path.exists(cfg1.output_img)
+    assert os.path.exists(output_filename + '_interrupted' + file_extension)
+
+
+def test_conv_style_layer(tmp_path):
+    # Style loss output go through the (inplace in backbone) ReLU after the conv layer 
+    cfg1, _, dtype, device, backbone = small_setup(tmp_path)
+    cfg1.style_layers = 'conv1_2,relu2_1'
+    content_img, style_img, _, tight_mask, loss_mask = preprocess(cfg1, dtype, device)
+
+    content_loss_list, style_loss_list, tv_loss_list, histogram_loss_list, net = build_net(cfg1, device, dtype, tight_mask, loss_mask, StyleLossPass1, ContentLoss, TVLoss, HistogramLoss, backbone=backbone)
+    capture_fm_pass1(content_loss_list, style_loss_list, tv_loss_list, content_img, style_img, net)
+    img = train(cfg1, device, dtype, net, tight_mask, loss_mask, content_img, content_loss_list, style_loss_list, tv_loss_list, histogram_loss_list)[0]
+    assert torch.isfinite(img).all()
+    # ReLU of the shared backbone is not changed 
+    assert all(layer.inplace for layer in backbone[0] if isinstance(layer, nn.ReLU))
+
+
+def test_incremental_net_match_full_forward(tmp_path):
+    cfg1, _, dtype, device, backbone = small_setup(tmp_path)
+    content_img, style_img, _, tight_mask, loss_mask = preprocess(cfg1, dtype, device)
+
+    content_loss_list, style_loss_list, tv_loss_list, histogram_loss_list, net = build_net(cfg1, device, dtype, tight_mask, loss_mask, StyleLossPass1, ContentLoss, TVLoss, HistogramLoss, backbone=backbone)
+    capture_fm_pass1(content_loss_list, style_loss_list, tv_loss_list, content_img, style_img, net)
+    loss_modules = content_loss_list + style_loss_list + tv_loss_list + histogram_loss_list
+    for param in net.parameters():
+        param.requires_grad = False
+
+    def loss_and_grad(forward, img):
+        img = img.clone().requires_grad_(True)
+        forward(img)
+        total_loss = sum(module.loss for module in loss_modules)
+        total_loss.backward()
+        return total_loss.detach(), img.grad * loss_mask.expand_as(img)
+
+    # First forward fill the cache, then change a small region away from the mask 
+    incremental_net = IncrementalNet(net, grad_mask=loss_mask, max_dirty=1)
+    loss_and_grad(incremental_net, content_img)
+    img = content_img.clone()
+    img[:, :, 2:6, 3:9] += torch.rand(1, 3, 4, 6, dtype=img.dtype, device=img.device)
+    assert incremental_net.dirty_region(img) is not None
+
+    loss, grad = loss_and_grad(incremental_net, img)
+    full_loss, full_grad = loss_and_grad(net, img)
+    assert torch.allclose(loss, full_loss, rtol=1e-5)
+    assert torch.allclose(grad, full_grad, rtol=1e-4, atol=1e-6 * full_grad.abs().max().item())
@@ -16,6 +16,10 @@ import numpy as np
 import scipy.interpolate as interpolate
 import matplotlib.pyplot as plt
 import sys 
+import json 
+import queue 
+import threading 
+import resource 
 
 def init_log(cfg):
     orig_stdout = sys.stdout
@@ -51,7 +55,7 @@ def setup(cfg):
     return dtype, device
 
 
-def get_args():
+def build_parser():
     parser = argparse.ArgumentParser()
     # Input Output
     parser.add_argument("-style_image", help="./path/file to style image", default='data/0_target.jpg')
@@ -64,16 +68,23 @@ def get_args():
                         default=512)
 
     # Training Parameter
-    parser.add_argument("-optim", choices=['lbfgs', 'adam'], default='adam') # lbfgs currently not support 
-    parser.add_argument("-lr", type=float, default=1e0)
+    parser.add_argument("-optim", choices=['lbfgs', 'adam'], default='adam')
+    parser.add_argument("-lbfgs_history", help="number of past update kept by L-BFGS", type=int, default=100)
+    parser.add_argument("-lr", help="learning rate of adam, for lbfgs the first step of the line search (1 is usual)", type=float, default=1e0)
     parser.add_argument("-n_iter", type=int, default=1000)
     parser.add_argument("-print_interval", type=int, default=150) 
+    parser.add_argument("-converge_tol", help="stop when relative change of total loss over `converge_window` iteration is below this, 0 means always run n_iter", type=float, default=0)
+    parser.add_argument("-converge_window", type=int, default=50)
     parser.add_argument("-save_img_interval", type=int, default=50)
+    parser.add_argument("-save_loss_history", help="save loss of every loss layer at every iteration to <output_img>_loss.json", action='store_true')
+    parser.add_argument("-save_img_policy", help="snapshot every save_img_interval iteration, at log spaced iteration or only the final image", choices=['interval', 'log', 'final'], default='interval')
+    parser.add_argument("-checkpoint_interval", help="save image, optimizer state, loss history & captured target to <output_img>_checkpoint.pth every this many iteration, 0 means no checkpoint", type=int, default=0)
+    parser.add_argument("-resume", help="continue from <output_img>_checkpoint.pth if it exist, feature map capture & match is skipped", action='store_true')
     parser.add_argument("-gpu", help="Zero-indexed ID of the GPU to use; for CPU mode set -gpu = cpu", default='cpu')
 
     # Model Parameter
-    parser.add_argument("-content_layers", help="layers for content", default='relu4_2')
-    parser.add_argument("-style_layers", help="layers for style", default='relu3_1,relu4_1,relu5_1') # Layer choice for Deep Paintely Harmonization 
+    parser.add_argument("-content_layers", help="layers for content, name that is not a layer of the model is ignored with a warning", default='relu4_2')
+    parser.add_argument("-style_layers", help="layers for style, name that is not a layer of the model is ignored with a warning", default='relu3_1,relu4_1,relu5_1') # Layer choice for Deep Paintely Harmonization 
     #parser.add_argument("-style_layers", help="layers for style", default='relu1_1,relu2_1,relu3_1,relu4_1,relu5_1') # Layer choice for A Neural Algorithm of Artistic Style by Leon A. Gatys
     parser.add_argument("-histogram_layers", help="layers for histogram loss, only use for pass2", default='relu1_1,relu4_1') # Not used in pass1
     parser.add_argument("-content_weight", type=float, default=5e0)
@@ -85,42 +96,124 @@ def get_args():
     parser.add_argument("-model_file", help="path/file to saved model file, if not will auto download", default='./download_model_weight/vgg19-d01eb7cb.pth')
     parser.add_argument("-model", choices=['vgg16', 'vgg19'], default='vgg19')
     parser.add_argument("-match_patch_size", type=int, default=3)
+    parser.add_argument("-match_mem_budget", help="memory (MB) for a single score block during feature map match", type=float, default=256)
+    parser.add_argument("-match_region", help="match whole feature map or only location inside loss mask", choices=['full', 'mask'], default='full')
+    parser.add_argument("-matcher", help="exhaustive or approximate (PatchMatch) feature map match", choices=['exact', 'patchmatch'], default='exact')
+    parser.add_argument("-patchmatch_iter", help="number of PatchMatch propagation & random search iteration", type=int, default=5)
+    parser.add_argument("-coarse_to_fine", help="pass1 only, full match at the deepest style layer, other layer refine the upsampled match", action='store_true')
+    parser.add_argument("-match_window", help="radius of the window searched around the upsampled match in coarse to fine mode", type=int, default=2)
+    parser.add_argument("-gram_symmetric", help="only compute upper triangle blocks of style gram matrix & mirror them", action='store_true')
     parser.add_argument("-generator_model", choices=['skip_depth6', 'skip_depth4', 'skip_depth2', 'UNET', 'ResNet']) # For DIP ANALYSIS 
     parser.add_argument("-noise_input_depth", type=int, default=1) # input depth for noise input to generator model 
 
     # Other 
     parser.add_argument('-log_on', choices=['on', 'off'], default='off') # if 'on' is choose, redirect output to log file 
     parser.add_argument('-log_file', help='log file name', default='log.txt')
+    parser.add_argument('-batch_file', help='json list of job (option override) optimized together as one batch, all image must have the same size', default=None)
+    parser.add_argument('-pyramid_levels', help='number of resolution level, each level double the size, 1 means no pyramid. Capped so the deepest loss layer is at least match_patch_size at the coarsest level', type=int, default=1)
+    parser.add_argument('-pyramid_iter', help='comma separated iteration of each level (coarse to fine), default n_iter/s for level at 1/s resolution and n_iter/5 for full resolution', type=str, default=None)
+    parser.add_argument('-tile_size', help='optimize overlapping tile of this size (pixel) one by one, 0 means no tile', type=int, default=0)
+    parser.add_argument('-tile_overlap', help='overlap (pixel) between neighbor tile, result is feathered over the overlap', type=int, default=64)
+    parser.add_argument('-tile_style_context', help='pass1 only, style window of a tile is the tile grown by this many pixel, -1 means the whole style image', type=int, default=-1)
+    parser.add_argument('-roi', help='only optimize the bounding box of dilated mask (plus a receptive field margin)', action='store_true')
+    parser.add_argument('-roi_margin', help='margin (pixel) around dilated mask in roi mode, default is the receptive field of the deepest loss layer', type=int, default=None)
+    parser.add_argument('-incremental', help='reuse cached feature map outside the updated region during optimization', action='store_true')
+    parser.add_argument('-incremental_max_dirty', help='run full forward when updated region cover more than this portion of image', type=float, default=0.5)
+    parser.add_argument('-grad_checkpoint', help='recompute activation between loss layer during backward instead of keeping it, lower memory with more compute', action='store_true')
     parser.add_argument('-verbose', help='print_information', action='store_true') # Print loss information during training or not
 
-    cfg = parser.parse_args()
+    return parser
+
+
+def get_args(argv=None, parser=None):
+    '''
+    Input : 
+        argv : list of argument, default sys.argv 
+        parser : parser with extra option (e.g. harmonize.py), default build_parser() 
+    '''
+    if parser is None:
+        parser = build_parser()
+    cfg = parser.parse_args(argv)
 
     print('\n===> Configuration Setup')
     print('style loss layer', cfg.style_layers)
     print('content loss layer', cfg.content_layers)
     print('histogram loss layer', cfg.histogram_layers)
 
+    assert(not ((cfg.resume or cfg.checkpoint_interval > 0) and (cfg.batch_file is not None or cfg.tile_size > 0 or cfg.pyramid_levels > 1))), \
+        '-checkpoint_interval & -resume can not be used with -batch_file, -tile_size or -pyramid_levels'
+
     return cfg
 
 
-#def build_optimizer(cfg, img):
-#    '''
-#    Input:
-#        img : Tensor type image with require_grad = True
-#            can be build by passing image through `img = nn.Parameter(img)`
-#    '''
-#    # optimizer = torch.optim.SGD(model.parameters(), lr = 0.001)
-#    assert(img.requires_grad==True)
-#    if cfg.optim == 'adam':
-#        optimizer = torch.optim.Adam([img], cfg.lr)
-#    elif cfg.optim == 'lbfgs':
-#        # TODO lbfgs optimizer setup is different then Adam, setup this 
-#        optimizer = None
-#    else:
-#        # TODO raise error that optimizer type not support 
-#        return None
-#    
-#    return optimizer
+def build_optimizer(cfg, img):
+    '''
+    Input:
+        img : Tensor type image with require_grad = True
+            can be build by passing image through `img = nn.Parameter(img)`
+    Notice : 
+        L-BFGS keep its history across step & `train` set how many closure call a step may take (see `step_budget`), 
+        so early stop can be checked between step. Stopping is left to `train`. L-BFGS use strong Wolfe line search, 
+        so `lr` is only the first step it try (every closure call count as one iteration in `train`) 
+    '''
+    assert(img.requires_grad==True)
+    if cfg.optim == 'adam':
+        optimizer = torch.optim.Adam([img], cfg.lr)
+    elif cfg.optim == 'lbfgs':
+        # max_iter & max_eval are replaced before every step by `step_budget` 
+        optimizer = torch.optim.LBFGS([img], lr=cfg.lr, max_iter=1, max_eval=25, history_size=cfg.lbfgs_history, tolerance_grad=-1, tolerance_change=-1,
+                                      line_search_fn='strong_wolfe')
+    
+    return optimizer
+
+
+def step_budget(cfg, i_iter):
+    '''
+    Return : 
+        number of closure call the next L-BFGS step may take from iteration `i_iter`, up to `n_iter`, the next 
+        converge check & the next checkpoint. Every step start by evaluating the current image again, which the 
+        line search of the previous step already did, so a step run as many iteration as it can 
+    Notice : 
+        the line search can take one call over the budget 
+    '''
+    budget = cfg.n_iter + 1 - i_iter
+    if cfg.converge_tol > 0:
+        budget = min(budget, max(cfg.converge_window, -(-i_iter // cfg.converge_window) * cfg.converge_window) - i_iter + 1)
+    if cfg.checkpoint_interval > 0:
+        budget = min(budget, (i_iter // cfg.checkpoint_interval + 1) * cfg.checkpoint_interval - i_iter)
+    return max(1, budget)
+
+
+# Option that can be set per job in batch file, other option is shared by the whole batch 
+batch_job_options = ['content_image', 'style_image', 'inter_image', 'tight_mask', 'dilated_mask', 'output_img',
+                     'content_weight', 'style_weight', 'tv_weight', 'histogram_weight']
+
+
+def load_batch_cfgs(cfg):
+    '''
+    Input : 
+        cfg.batch_file : json list of job, each job is a dict of option override cfg, e.g. 
+            [{"content_image": "data/1_naive.jpg", "style_image": "data/1_target.jpg", ..., "output_img": "output/1_inter_res.jpg"}, ...]
+    Return : 
+        list of cfg, one for each job 
+    Notice : 
+        tv / histogram loss must be on (weight > 0) or off for all job, so all job has the same loss layers 
+    '''
+    with open(cfg.batch_file) as f:
+        jobs = json.load(f)
+
+    job_cfgs = []
+    for job in jobs:
+        job_cfg = copy.copy(cfg)
+        for key, value in job.items():
+            assert (key in batch_job_options), 'option {} can not be set per job, choose from {}'.format(key, ', '.join(batch_job_options))
+            setattr(job_cfg, key, value)
+        assert ((job_cfg.tv_weight > 0) == (cfg.tv_weight > 0)), 'tv loss must be on / off for all job'
+        assert ((job_cfg.histogram_weight > 0) == (cfg.histogram_weight > 0)), 'histogram loss must be on / off for all job'
+        job_cfgs.append(job_cfg)
+
+    print('\n===> Load {} Job from {}'.format(len(job_cfgs), cfg.batch_file))
+    return job_cfgs
 
 
 def mask_preprocess(mask_file, out_shape):
@@ -216,6 +309,172 @@ def img_deprocess(img_tensor, norm=True):
     return img 
 
 
+class SnapshotWriter(object):
+    '''
+    Functionality : 
+        deprocess & encode image in a background thread, so saving snapshot do not block the optimization 
+    Input : 
+        max_queue : number of image waiting to be saved, `save` block when queue is full 
+    Notice : 
+        `close` MUST be called (wait until every queued image is saved) 
+    '''
+    def __init__(self, max_queue=4):
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def save(self, img_tensor, filename):
+        # Copy to cpu so the optimizer can keep updating the image 
+        self.queue.put((img_tensor.detach().to('cpu', copy=True), str(filename)))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            img_tensor, filename = item
+            try:
+                img_deprocess(img_tensor).save(filename)
+            except Exception as e:
+                print('Fail to save image {} : {}'.format(filename, str(e)))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+class LossHistory(object):
+    '''
+    Functionality : 
+        loss of every loss layer is recorded each iteration into a preallocated device buffer (no synchronization), 
+        and only copied to host in bulk when `fetch` is called (print / save interval) or the buffer is full 
+    Input : 
+        names : name of each loss layer `<kind>_<k>`, e.g. ['content_1', 'style_1', 'style_2', 'tv_1'], 
+                in batch mode prefixed by the job `job<n>_` 
+        capacity : number of iteration kept on device 
+    '''
+    def __init__(self, names, device, capacity=256):
+        self.names = list(names)
+        self.buffer = torch.zeros((capacity, len(self.names)), device=device)
+        self.n_record = 0  # number of iteration recorded 
+        self.host = np.zeros((0, len(self.names)))  # iteration already copied to host 
+
+    def record(self, losses):
+        if self.n_record - self.host.shape[0] == self.buffer.shape[0]:
+            self.fetch()
+        if len(losses) > 0:
+            self.buffer[self.n_record % self.buffer.shape[0]] = torch.stack([loss.detach().reshape(()) for loss in losses])
+        self.n_record += 1
+
+    def fetch(self):
+        '''
+        Return : 
+            n_record * n_layer numpy array, loss of every layer at every recorded iteration 
+        '''
+        if self.n_record > self.host.shape[0]:
+            rows = torch.arange(self.host.shape[0], self.n_record) % self.buffer.shape[0]
+            self.host = np.concatenate([self.host, self.buffer[rows.to(self.buffer.device)].cpu().numpy()])
+        return self.host
+
+    def columns(self, kind, job=None):
+        prefix = '' if job is None else 'job{}_'.format(job)
+        return [i for i, name in enumerate(self.names) if name.startswith(prefix) and name.rsplit('_', 2)[-2] == kind]
+
+    def summary(self, kind, job=None):
+        '''
+        Return : 
+            sum of loss of layer `kind` (content / style / tv / histogram) of `job` (all job if None) at every iteration 
+        '''
+        return self.fetch()[:, self.columns(kind, job)].sum(1)
+
+    def restore(self, host):
+        '''
+        Input : 
+            host : n_record * n_layer numpy array from `fetch`, e.g. of a checkpoint 
+        '''
+        self.host = np.array(host)
+        self.n_record = self.host.shape[0]
+
+    def save(self, filename):
+        history = self.fetch()
+        with open(filename, 'w') as f:
+            json.dump({name: history[:, i].tolist() for i, name in enumerate(self.names)}, f)
+
+
+# Attribute of loss module that is recomputed (with graph) every forward, not kept in checkpoint 
+transient_loss_attrs = ['loss', 'x_diff', 'y_diff']
+
+
+def loss_module_state(module):
+    '''
+    Return : 
+        dict of attribute (target, mask, mode, ...) of a loss module & its sub module, everything set by capture is included 
+    '''
+    state = {k: v for k, v in vars(module).items() if not k.startswith('_') and k not in transient_loss_attrs}
+    state['_modules'] = {name: loss_module_state(sub_module) for name, sub_module in module._modules.items()}
+    return state
+
+
+def load_loss_module_state(module, state):
+    for k, v in state.items():
+        if k == '_modules':
+            for name, sub_state in v.items():
+                load_loss_module_state(module._modules[name], sub_state)
+        else:
+            setattr(module, k, v)
+
+
+def checkpoint_filename(cfg):
+    output_filename, _ = os.path.splitext(cfg.output_img)
+    return str(output_filename) + '_checkpoint.pth'
+
+
+def save_checkpoint(cfg, img, optimizer, i_iter, converged, history, loss_modules):
+    '''
+    Functionality : 
+        save everything `train` need to continue, i_iter is the next iteration to run. Written to a temporary file first 
+        so a kill during save keep the previous checkpoint 
+    '''
+    filename = checkpoint_filename(cfg)
+    state = {'i_iter': i_iter, 'converged': converged, 'img': img.detach(), 'optimizer': optimizer.state_dict(), 
+             'history': history.fetch(), 'loss_modules': [loss_module_state(module) for module in loss_modules]}
+    torch.save(state, filename + '.tmp')
+    os.replace(filename + '.tmp', filename)
+
+
+def load_checkpoint(cfg, device):
+    '''
+    Return : 
+        state saved by save_checkpoint, None if there is no checkpoint 
+    '''
+    filename = checkpoint_filename(cfg)
+    if not os.path.exists(filename):
+        print('\n===> No Checkpoint {}, Start from Beginning'.format(filename))
+        return None
+
+    print('\n===> Resume from Checkpoint {}'.format(filename))
+    try:
+        return torch.load(filename, map_location=device, weights_only=False)
+    except TypeError:
+        # torch < 1.13 
+        return torch.load(filename, map_location=device)
+
+
+def snapshot_due(cfg, i_iter):
+    '''
+    Return : 
+        if snapshot should be saved at iteration `i_iter` under `cfg.save_img_policy`
+            interval : every `cfg.save_img_interval` iteration 
+            log : iteration 0, 1, 2, 4, 8, ... 
+            final : never (final image is always saved) 
+    '''
+    if cfg.save_img_policy == 'interval':
+        return i_iter % cfg.save_img_interval == 0
+    elif cfg.save_img_policy == 'log':
+        return i_iter & (i_iter - 1) == 0
+    return False
+
+
 def preprocess(cfg, dtype, device, norm=True):
     '''
     Return : 
@@ -225,7 +484,9 @@ def preprocess(cfg, dtype, device, norm=True):
     content_img = img_preprocess(cfg.content_image, cfg.output_img_size, norm=norm).type(dtype).to(device) # 1 * 3 * H * W [0.-255.]
     img_size = (content_img.shape[2], content_img.shape[3]) 
     style_img = img_preprocess(cfg.style_image, img_size, norm=norm).type(dtype).to(device) # 1 * 3 * H * W [0.-255.]
-    inter_img = img_preprocess(cfg.inter_image, img_size).type(dtype).to(device) # 1 * 3 * H * W [0.-255.]s
+    inter_img = None # harmonize.py run pass1 & pass2 in one process, no intermediate image file 
+    if cfg.inter_image is not None:
+        inter_img = img_preprocess(cfg.inter_image, img_size).type(dtype).to(device) # 1 * 3 * H * W [0.-255.]s
     tight_mask = mask_preprocess(cfg.tight_mask, img_size).type(dtype).to(device) # 1 * 1 * H * W [0/1]
     loss_mask = mask_preprocess(cfg.dilated_mask, img_size).type(dtype).to(device) # 1 * 1 * H * W [0/1]
     print('\n===> Preprocess Image and Mask')
@@ -274,6 +535,7 @@ def plt_plot_loss(style_loss_his, content_loss_his, tv_loss_his, histogram_loss_
     plt.ylabel('Loss')
     plt.legend(loc = "best")
     plt.savefig(name+'loss_history.png')
+    plt.close()
 
 
 def dilate_mask(mask):
@@ -285,6 +547,110 @@ def dilate_mask(mask):
     return loose_mask
 
 
+def mask_bbox(mask, margin=0, align=1):
+    '''
+    Input : 
+        mask : 1 * 1 * H * W 
+        margin : number of pixel the bounding box is grown on every side 
+        align : start of the box is a multiple of `align` & size is round up to multiple of `align` (when inside image)
+    Return : 
+        (y0, y1, x0, x1) bounding box of the nonzero mask, clipped to the mask 
+    '''
+    H, W = mask.shape[2], mask.shape[3]
+    nonzero = torch.nonzero(mask[0, 0])
+    y0 = max(0, int(nonzero[:, 0].min()) - margin) // align * align
+    x0 = max(0, int(nonzero[:, 1].min()) - margin) // align * align
+    y1 = min(H, int(nonzero[:, 0].max()) + 1 + margin)
+    x1 = min(W, int(nonzero[:, 1].max()) + 1 + margin)
+    y1 = min(H, y0 + int(math.ceil((y1 - y0) / align)) * align)
+    x1 = min(W, x0 + int(math.ceil((x1 - x0) / align)) * align)
+    return y0, y1, x0, x1
+
+
+def roi_crop(tensor, bbox):
+    '''
+    Return : 
+        B * C * (y1 - y0) * (x1 - x0) crop of tensor inside bbox 
+    '''
+    y0, y1, x0, x1 = bbox
+    return tensor[:, :, y0:y1, x0:x1].contiguous()
+
+
+def roi_paste(tensor, crop, bbox):
+    '''
+    Return : 
+        copy of tensor with the region inside bbox replaced by crop 
+    '''
+    y0, y1, x0, x1 = bbox
+    output = tensor.detach().clone()
+    output[:, :, y0:y1, x0:x1] = crop.detach()
+    return output
+
+
+def tile_boxes(mask, tile_size, overlap, align=1):
+    '''
+    Input : 
+        mask : 1 * 1 * H * W 
+        tile_size, overlap : size of tile & overlap between neighbor tile (pixel) 
+        align : start of tile is a multiple of `align` 
+    Return : 
+        list of (y0, y1, x0, x1) overlapping tile that cover the bounding box of the nonzero mask, tile without mask is skipped 
+    '''
+    H, W = mask.shape[2], mask.shape[3]
+    y0, y1, x0, x1 = mask_bbox(mask)
+    step = max(align, (tile_size - overlap) // align * align)
+
+    def starts(lo, hi, size):
+        out = []
+        start = lo // align * align
+        while True:
+            start = min(start, max(0, size - tile_size) // align * align)  # last tile stay inside image 
+            out.append(start)
+            if start + tile_size >= hi:
+                return out
+            start += step
+
+    boxes = []
+    for ty in starts(y0, y1, H):
+        for tx in starts(x0, x1, W):
+            box = (ty, min(H, ty + tile_size), tx, min(W, tx + tile_size))
+            if mask[:, :, box[0]:box[1], box[2]:box[3]].sum() > 0:
+                boxes.append(box)
+    return boxes
+
+
+def feather_weight(bbox, size, overlap):
+    '''
+    Return : 
+        1 * 1 * h * w blending weight of a tile, 1 inside & linearly go down to 0 over `overlap` pixel 
+        toward tile border (image border is not feathered) 
+    '''
+    y0, y1, x0, x1 = bbox
+    H, W = size
+
+    def ramp(lo, hi, length):
+        pos = torch.arange(hi - lo).float()
+        weight = torch.ones(hi - lo)
+        if lo > 0:
+            weight = torch.min(weight, (pos + 1) / (overlap + 1))
+        if hi < length:
+            weight = torch.min(weight, (hi - lo - pos) / (overlap + 1))
+        return weight
+
+    weight_h, weight_w = ramp(y0, y1, H), ramp(x0, x1, W)
+    return (weight_h.view(-1, 1) * weight_w.view(1, -1)).view(1, 1, y1 - y0, x1 - x0)
+
+
+def peak_memory(device):
+    '''
+    Return : 
+        peak memory (MB), allocated tensor memory since last reset on gpu, max resident set size of the process on cpu 
+    '''
+    if torch.device(device).type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
 def tight_mask_crop(cfg, result, style_img, tight_mask):
     '''
     Input:
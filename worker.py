@@ -0,0 +1,184 @@
+# EECS 442 @ UMich Final Project 
+# No commercial Use Allowed 
+
+import os
+import time
+import json
+import traceback
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import torch
+from model import *
+from utils import *
+from harmonize import get_harmonize_args, harmonize
+
+
+def get_worker_args(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-host", help="address to listen on", default='127.0.0.1')
+    parser.add_argument("-port", help="port to listen on", type=int, default=8442)
+    parser.add_argument("-unix_socket", help="path/file of unix socket to listen on instead of host & port", default=None)
+    parser.add_argument("-slots", help="number of job that run at the same time, other job wait in queue", type=int, default=1)
+    parser.add_argument("-gpu", help="device of every job, zero-indexed ID of the GPU or 'cpu'", default='cpu')
+    parser.add_argument("-model_file", help="path/file to saved model file", default='./download_model_weight/vgg19-d01eb7cb.pth')
+    parser.add_argument("-model", choices=['vgg16', 'vgg19'], default='vgg19')
+    cfg = parser.parse_args(argv)
+    return cfg
+
+
+def job_argv(job):
+    '''
+    Input :
+        job : json body of request, option of get_harmonize_args either as argument list or as dict, e.g.
+              {"args": ["-content_image", "data/1_naive.jpg", "-verbose"]} or {"options": {"content_image": "data/1_naive.jpg", "verbose": true}}
+    Return :
+        argument list for get_harmonize_args
+    '''
+    argv = [str(arg) for arg in job.get('args', [])]
+    for name, value in job.get('options', {}).items():
+        if value is True:
+            argv.append('-' + name)
+        elif value is not False and value is not None:
+            argv += ['-' + name, str(value)]
+    return argv
+
+
+class Worker(object):
+    '''
+    Functionality :
+        keep the backbone loaded & run harmonize job in the thread of the request, at most `slots` job run at the
+        same time, other job wait in arrival order
+    Notice :
+        1. backbone is built up to the last layer so any loss layer of a job can be used
+        2. `-gpu`, `-model`, `-model_file` of a job are replaced by the one of the worker
+    '''
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.dtype, self.device = setup(cfg)
+        layer_list = vgg16_dict if cfg.model == 'vgg16' else vgg19_dict
+        self.backbone = build_backbone(cfg, layers=[layer_list[-1]])
+        self.backbone[0].to(self.device)
+
+        # Intra op thread is split between slot on cpu 
+        if cfg.gpu == 'cpu':
+            torch.set_num_threads(max(1, torch.get_num_threads() // cfg.slots))
+
+        # Job take a ticket & run when it is the next ticket and a slot is free 
+        self.cond = threading.Condition()
+        self.next_ticket, self.serving, self.n_running, self.n_done = 0, 0, 0, 0
+
+    def acquire(self):
+        with self.cond:
+            ticket = self.next_ticket
+            self.next_ticket += 1
+            self.cond.wait_for(lambda: ticket == self.serving and self.n_running < self.cfg.slots)
+            self.serving += 1
+            self.n_running += 1
+            self.cond.notify_all()
+
+    def release(self):
+        with self.cond:
+            self.n_running -= 1
+            self.n_done += 1
+            self.cond.notify_all()
+
+    def status(self):
+        with self.cond:
+            return {'slots': self.cfg.slots, 'running': self.n_running, 'queued': self.next_ticket - self.serving, 'done': self.n_done}
+
+    def run(self, job):
+        '''
+        Return :
+            result of harmonize, time waiting for a slot is added to `timing` as `queue`
+        '''
+        cfg1, cfg2 = get_harmonize_args(job_argv(job))
+        for cfg in (cfg1, cfg2):
+            cfg.gpu, cfg.model, cfg.model_file = self.cfg.gpu, self.cfg.model, self.cfg.model_file
+
+        queue_start = time.time()
+        self.acquire()
+        try:
+            queue_time = time.time() - queue_start
+            result = harmonize(cfg1, cfg2, self.dtype, self.device, self.backbone, plot=False)
+        finally:
+            self.release()
+        result['timing']['queue'] = queue_time
+        return result
+
+
+class WorkerHandler(BaseHTTPRequestHandler):
+    '''
+    Functionality :
+        POST /harmonize run one job & reply with output path and timing, GET /status reply with slot & queue size
+    '''
+    worker = None
+
+    def send_json(self, code, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != '/status':
+            return self.send_json(404, {'status': 'error', 'error': 'unknown path {}'.format(self.path)})
+        self.send_json(200, self.worker.status())
+
+    def do_POST(self):
+        if self.path != '/harmonize':
+            return self.send_json(404, {'status': 'error', 'error': 'unknown path {}'.format(self.path)})
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            job = json.loads(self.rfile.read(length).decode('utf-8') or '{}')
+        except ValueError as e:
+            return self.send_json(400, {'status': 'error', 'error': 'invalid json: {}'.format(e)})
+
+        try:
+            result = self.worker.run(job)
+        except SystemExit:
+            # argparse exit on invalid option 
+            return self.send_json(400, {'status': 'error', 'error': 'invalid option {}'.format(job_argv(job))})
+        except Exception as e:
+            traceback.print_exc()
+            return self.send_json(500, {'status': 'error', 'error': repr(e)})
+
+        result['status'] = 'done'
+        self.send_json(200, result)
+
+    def address_string(self):
+        # client of unix socket has no (host, port) address 
+        return str(self.client_address[0]) if isinstance(self.client_address, tuple) and self.client_address else 'unix'
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def main():
+    cfg = get_worker_args()
+
+    WorkerHandler.worker = Worker(cfg)
+
+    if cfg.unix_socket is not None:
+        if os.path.exists(cfg.unix_socket):
+            os.remove(cfg.unix_socket)
+        server = ThreadingUnixHTTPServer(cfg.unix_socket, WorkerHandler)
+        print('\n===> Worker listen on {} with {} slot'.format(cfg.unix_socket, cfg.slots))
+    else:
+        server = ThreadingHTTPServer((cfg.host, cfg.port), WorkerHandler)
+        print('\n===> Worker listen on {}:{} with {} slot'.format(cfg.host, cfg.port, cfg.slots))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('\n===> Worker Stop')
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()